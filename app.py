@@ -1,13 +1,21 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, jsonify
+from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, or_
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from datetime import datetime
 import os
+import re
+import json
+import time
 from dotenv import load_dotenv
-from ui.models import db, User, ChatSession, Chat
+from ui.models import db, User, ChatSession, Chat, init_search_schema, search_sessions, delete_sessions
 from ui.forms import LoginForm, SignupForm
-from data.retriever.hybrid_retriever import rag_advisor
+from data.retriever.hybrid_retriever import rag_advisor, rag_advisor_stream, conversation_memory, embedding_cache, answer_cache
+from data.retriever.tracing import render_prometheus, metrics as rag_metrics
+from data.clients import warm_pool
 import markdown
+import nh3
+from markupsafe import Markup
 load_dotenv()
 # ====================
 # App Initialization
@@ -19,6 +27,10 @@ app = Flask(__name__,
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY")
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("SQLALCHEMY_DATABASE_URI")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+MESSAGE_PAGE_SIZE = int(os.getenv("MESSAGE_PAGE_SIZE", "30"))
+# Minimum seconds between the rendered-HTML snapshots sent while an answer streams
+STREAM_RENDER_INTERVAL = float(os.getenv("STREAM_RENDER_INTERVAL", "0.2"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 
 db.init_app(app)
 
@@ -77,6 +89,67 @@ def logout():
 # ====================
 # Routes - Chat
 # ====================
+def load_chat_turns(session_id, limit):
+    """Load the latest turns of a session for conversation_memory, oldest first; called on every turn."""
+    rows = (Chat.query.filter_by(session_id=session_id).order_by(Chat.timestamp.desc(), Chat.id.desc())
+            .limit(limit).all())
+    return [{"id": row.id, "role": "assistant" if row.sender == 'bot' else "user",
+             "content": re.sub(r'<[^>]+>', '', row.message)} for row in reversed(rows)]
+
+
+conversation_memory.loader = load_chat_turns
+
+
+def format_bot_response(response):
+    """Render the LLM's markdown answer to the HTML stored in Chat rows."""
+    if response:
+        response = response.replace("```markdown", "").replace("```","")
+        return markdown.markdown(response)
+    return "Oops!!! Sorry...."
+
+
+@app.template_filter('sanitize_html')
+def sanitize_html(html):
+    """Strip scripts, event handlers and unsafe URLs from bot HTML before it reaches the page."""
+    return Markup(nh3.clean(html))
+
+
+def save_turn(session_id, user_msg, response):
+    """Store a user message and the bot's reply, filling in the session title on the first turn."""
+    bot_reply = Chat(session_id=session_id, message=format_bot_response(response),
+                     timestamp=datetime.utcnow(), sender='bot')
+    ChatSession.query.filter_by(id=session_id, title=None).update({"title": user_msg.message[:200]})
+    db.session.add_all([user_msg, bot_reply])
+    db.session.commit()
+    return user_msg, bot_reply
+
+
+def message_cursor(msg):
+    return f"{msg.timestamp.isoformat()},{msg.id}"
+
+
+def load_messages(session_id, before=None, limit=MESSAGE_PAGE_SIZE):
+    """
+    Keyset page of a session's messages older than the `before` cursor ("<iso timestamp>,<id>").
+    Returns the page oldest-first and the cursor for the next older page, or None at the start.
+    """
+    query = Chat.query.filter_by(session_id=session_id)
+    if before:
+        timestamp, message_id = before.rsplit(",", 1)
+        timestamp, message_id = datetime.fromisoformat(timestamp), int(message_id)
+        query = query.filter(or_(Chat.timestamp < timestamp,
+                                 and_(Chat.timestamp == timestamp, Chat.id < message_id)))
+    rows = query.order_by(Chat.timestamp.desc(), Chat.id.desc()).limit(limit + 1).all()
+    older_cursor = message_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return list(reversed(rows[:limit])), older_cursor
+
+
+def serialize_message(msg):
+    message = sanitize_html(msg.message) if msg.sender == 'bot' else msg.message
+    return {"id": msg.id, "sender": msg.sender, "message": message,
+            "timestamp": msg.timestamp.strftime('%Y-%m-%d %H:%M')}
+
+
 @app.route('/chat', methods=['GET', 'POST'])
 @login_required
 def chat():
@@ -97,29 +170,80 @@ def chat():
         message = request.form['message']
 
         user_msg = Chat(session_id=session.id, message=message, timestamp=datetime.utcnow(), sender='user')
-        response = rag_advisor(message)
-        if response:
-            response = response.replace("```markdown", "").replace("```","")
-            response = markdown.markdown(response)
-        else:
-            response = "Oops!!! Sorry...."
-        bot_reply = Chat(session_id=session.id, message=response, timestamp=datetime.utcnow(), sender='bot')
-
-        db.session.add_all([user_msg, bot_reply])
-        db.session.commit()
+        save_turn(session.id, user_msg, rag_advisor(message, session.id))
 
-    # Get messages for this session
-    messages = Chat.query.filter_by(session_id=session.id).order_by(Chat.timestamp).all()
+    # Newest window of messages; older ones are fetched on scroll
+    messages, older_cursor = load_messages(session.id)
 
     # Get recent chat sessions for sidebar
     recent_sessions = ChatSession.query.filter_by(user_id=current_user.id).order_by(ChatSession.id.desc()).limit(5).all()
-    recent_chats = []
-    for s in recent_sessions:
-        first_msg = Chat.query.filter_by(session_id=s.id).order_by(Chat.timestamp).first()
-        title = first_msg.message if first_msg else f"Chat {s.id}"
-        recent_chats.append((s.id, title[:30]))
+    recent_chats = [(s.id, (s.title or f"Chat {s.id}")[:30]) for s in recent_sessions]
+
+    return render_template('chat.html', session=session, messages=messages, older_cursor=older_cursor,
+                           recent_chats=recent_chats)
 
-    return render_template('chat.html', session=session, messages=messages, recent_chats=recent_chats)
+
+@app.route('/api/sessions/<int:session_id>/messages', methods=['GET'])
+@login_required
+def list_messages(session_id):
+    ChatSession.query.filter_by(id=session_id, user_id=current_user.id).first_or_404()
+    limit = max(1, min(request.args.get('limit', MESSAGE_PAGE_SIZE, type=int), 100))
+    try:
+        messages, older_cursor = load_messages(session_id, request.args.get('before'), limit)
+    except ValueError:
+        return jsonify(error="Invalid cursor"), 400
+    return jsonify(messages=[serialize_message(m) for m in messages], older_cursor=older_cursor)
+
+
+@app.route('/api/sessions/<int:session_id>/messages', methods=['POST'])
+@login_required
+def post_message(session_id):
+    """Answer one message and return only the new user and bot messages."""
+    ChatSession.query.filter_by(id=session_id, user_id=current_user.id).first_or_404()
+    data = request.get_json(silent=True) or request.form
+    message = (data.get('message') or '').strip()
+    if not message:
+        return jsonify(error="No message provided"), 400
+    user_msg = Chat(session_id=session_id, message=message, timestamp=datetime.utcnow(), sender='user')
+    user_msg, bot_reply = save_turn(session_id, user_msg, rag_advisor(message, session_id))
+    return jsonify(messages=[serialize_message(user_msg), serialize_message(bot_reply)])
+
+
+@app.route('/chat/stream', methods=['POST'])
+@login_required
+def chat_stream():
+    """Server-sent events: stream answer tokens as they arrive, persist the turn when the stream closes."""
+    session = ChatSession.query.filter_by(id=request.args.get("session"), user_id=current_user.id).first_or_404()
+    session_id = session.id
+    message = request.form['message']
+    user_msg = Chat(session_id=session_id, message=message, timestamp=datetime.utcnow(), sender='user')
+    started = time.perf_counter()
+
+    def generate():
+        tokens = []
+        ttfb_ms = None
+        rendered_at = 0.0
+        try:
+            for token in rag_advisor_stream(message, session_id):
+                now = time.perf_counter()
+                if ttfb_ms is None:
+                    ttfb_ms = round((now - started) * 1000, 1)
+                    app.logger.info("chat_stream ttfb_ms=%s session=%s", ttfb_ms, session_id)
+                tokens.append(token)
+                event = {'token': token}
+                # Markdown is rendered and sanitised here, so the page never runs a markdown parser on LLM output
+                if now - rendered_at >= STREAM_RENDER_INTERVAL:
+                    event['html'] = sanitize_html(format_bot_response("".join(tokens)))
+                    rendered_at = now
+                yield f"data: {json.dumps(event)}\n\n"
+            done = {'ttfb_ms': ttfb_ms, 'html': sanitize_html(format_bot_response("".join(tokens)))}
+            yield f"event: done\ndata: {json.dumps(done)}\n\n"
+        finally:
+            # Runs on normal completion and on client disconnect alike
+            save_turn(session_id, user_msg, "".join(tokens))
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 # ====================
@@ -128,11 +252,8 @@ def chat():
 @app.route('/clear_history')
 @login_required
 def clear_history():
-    sessions = ChatSession.query.filter_by(user_id=current_user.id).all()
-    for s in sessions:
-        Chat.query.filter_by(session_id=s.id).delete()
-        db.session.delete(s)
-    db.session.commit()
+    for session_id in delete_sessions(current_user.id):
+        conversation_memory.forget(session_id)
     flash('Chat history cleared.')
     return redirect(url_for('chat', new=1))
 
@@ -141,13 +262,8 @@ def clear_history():
 @login_required
 def search():
     query = request.args.get('q', '')
-    sessions = ChatSession.query.filter_by(user_id=current_user.id).all()
-    matched_sessions = []
-    for s in sessions:
-        first_msg = Chat.query.filter_by(session_id=s.id).order_by(Chat.timestamp).first()
-        if first_msg and query.lower() in first_msg.message.lower():
-            matched_sessions.append((s.id, first_msg.message[:50]))  # Truncate preview
-    return jsonify(matched_sessions[:5])
+    matched_sessions = [(session_id, title[:50]) for session_id, title in search_sessions(current_user.id, query)]  # Truncate preview
+    return jsonify(matched_sessions)
 
 
 # ====================
@@ -162,23 +278,44 @@ def delete_chat():
     if not session_id:
         return jsonify(success=False, error="No session ID provided")
 
-    # Validate ownership
-    session = ChatSession.query.filter_by(id=session_id, user_id=current_user.id).first()
-    if not session:
-        return jsonify(success=False, error="Chat session not found or unauthorized")
-
     try:
-        # Delete all chats in this session
-        Chat.query.filter_by(session_id=session.id).delete()
-        # Delete session itself
-        db.session.delete(session)
-        db.session.commit()
+        # Delete the session and its chats; the user_id filter validates ownership
+        deleted = delete_sessions(current_user.id, session_id)
+        if not deleted:
+            return jsonify(success=False, error="Chat session not found or unauthorized")
+        conversation_memory.forget(deleted[0])
         return jsonify(success=True)
     except Exception as e:
         db.session.rollback()
         return jsonify(success=False, error=str(e))
 
 
+# ====================
+# Routes - Metrics
+# ====================
+def cache_gauges():
+    """Per-worker cache and memory gauges; with METRICS_DIR set they are shared with the other workers."""
+    embedding_stats = embedding_cache.stats()
+    answer_stats = answer_cache.stats()
+    return {
+        "rag_embedding_cache_hit_rate": ("Query embedding cache hit rate.", embedding_stats["hit_rate"]),
+        "rag_answer_cache_hit_rate": ("Semantic answer cache hit rate.", answer_stats["hit_rate"]),
+        "rag_answer_cache_entries": ("Answers held in the semantic answer cache.", answer_stats["entries"]),
+        "rag_sessions_in_memory": ("Chat sessions held in conversation memory.", len(conversation_memory)),
+    }
+
+
+rag_metrics.gauge_source = cache_gauges
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint: per-stage RAG latency histograms, token counters and cache gauges."""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return Response(status=401)
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
 # ====================
 # Routes - Static Pages
 # ====================
@@ -190,7 +327,21 @@ def about():
 # ====================
 # Run App
 # ====================
+def init_database():
+    """Create missing tables and upgrade existing ones; safe to run on every start."""
+    db.create_all()
+    init_search_schema()
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or upgrade the database schema (run by gunicorn.conf.py before workers start)."""
+    init_database()
+    print("Database schema is up to date")
+
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        init_database()
+    warm_pool()
     app.run(host='0.0.0.0', port=5000, debug=True)
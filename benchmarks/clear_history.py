@@ -0,0 +1,74 @@
+"""
+Clear-history cost for a user with many chat sessions: the per-session delete loop vs the
+set-based delete_sessions. Runs against a throwaway SQLite database.
+
+    python benchmarks/clear_history.py --sessions 5000 --messages 6
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from flask import Flask
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ui.models import db, User, ChatSession, Chat, delete_sessions  # noqa: E402
+
+
+def seed(sessions, messages):
+    user = User(username=f"bench-{time.time_ns()}", password_hash="x")
+    db.session.add(user)
+    db.session.flush()
+    chat_sessions = [ChatSession(user_id=user.id) for _ in range(sessions)]
+    db.session.add_all(chat_sessions)
+    db.session.flush()
+    now = datetime.utcnow()
+    db.session.bulk_insert_mappings(Chat, [
+        {"session_id": s.id, "message": f"message {i}", "timestamp": now, "sender": "user" if i % 2 == 0 else "bot"}
+        for s in chat_sessions for i in range(messages)
+    ])
+    db.session.commit()
+    return user.id
+
+
+def loop_delete(user_id):
+    # Previous clear_history: one Chat delete and one session delete per session
+    for s in ChatSession.query.filter_by(user_id=user_id).all():
+        Chat.query.filter_by(session_id=s.id).delete()
+        db.session.delete(s)
+    db.session.commit()
+
+
+def measure(name, delete, user_id):
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    start = time.perf_counter()
+    delete(user_id)
+    elapsed = time.perf_counter() - start
+    event.remove(db.engine, "before_cursor_execute", count)
+    print(f"{name:<10} {elapsed * 1000:>10.1f} ms  {statements[0]:>7} statements")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=6)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = Flask(__name__)
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            measure("loop", loop_delete, seed(args.sessions, args.messages))
+            measure("set-based", delete_sessions, seed(args.sessions, args.messages))
+            db.engine.dispose()
@@ -0,0 +1,142 @@
+"""
+Embedding profile evaluation: recall lost against memory saved for reduced dimensions and
+float16/int8 snapshot storage.
+
+Every profile (dimensions x dtype) is compared with the exact full-size float32 search over the
+same vectors: recall@k is the share of the baseline top-k that the profile still returns. Reduced
+dimensions are produced by truncating and re-normalising the full vectors, which is what the
+`dimensions` parameter of text-embedding-3 models does. Memory is reported as the snapshot bytes
+(page cache of VECTOR_ENGINE=local) and the Neo4j `vector` property payload (8 bytes per float).
+
+By default the corpus is the extracted component files embedded with the offline benchmark's
+hashed stand-in, queried with retrieval_queries.json. The stand-in is not trained to keep its
+leading dimensions meaningful, so the recall it reports for reduced dimensions is a lower bound.
+For real numbers, export full-size float32 snapshots first and sample node vectors as queries:
+
+    python -m data.retriever.vector_index --snapshot-dir /tmp/full_snapshots
+    python benchmarks/embedding_profiles.py --snapshot-dir /tmp/full_snapshots --output profiles.json
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+import numpy as np
+
+# Importing the offline benchmark puts the repo root on sys.path and points caches at its scratch directory
+from offline_retrieval import ROOT, SCRATCH, hashed_embedding, load_graph, git_commit
+from data.embedding_profile import MODEL_DIMENSIONS, EMBEDDING_MODEL  # noqa: E402
+from data.retriever.vector_index import (LocalVectorIndex, SNAPSHOT_DTYPES, normalise_rows,  # noqa: E402
+                                         write_snapshot, _read_meta)
+
+
+# -------------------------
+# Corpora
+# -------------------------
+def offline_corpus(rawdata, queries_path, dimensions):
+    """Hashed stand-in vectors for every node name, with the labelled benchmark queries."""
+    graph = load_graph(rawdata)
+    corpus = {label: (sorted(names), np.array([hashed_embedding(name, dimensions) for name in sorted(names)],
+                                              dtype=np.float32))
+              for label, names in graph.nodes.items()}
+    with open(queries_path, "r", encoding="utf-8") as file:
+        texts = [item["query"] for item in json.load(file)]
+    queries = np.array([hashed_embedding(text, dimensions) for text in texts], dtype=np.float32)
+    return corpus, {label: (queries, [None] * len(queries)) for label in corpus}
+
+
+def snapshot_corpus(snapshot_dir, queries_per_label, seed=0):
+    """Vectors of existing snapshots; a sample of each label's own vectors serves as its queries."""
+    rng = np.random.default_rng(seed)
+    corpus, queries = {}, {}
+    for meta_file in sorted(f for f in os.listdir(snapshot_dir) if f.endswith(".meta.json")):
+        meta = _read_meta(os.path.join(snapshot_dir, meta_file))
+        vectors = np.load(os.path.join(snapshot_dir, meta["vectors"])).astype(np.float32)
+        if meta.get("scales"):
+            vectors *= np.load(os.path.join(snapshot_dir, meta["scales"]))[:, None]
+        corpus[meta["label"]] = (meta["names"], vectors)
+        rows = rng.choice(len(vectors), min(queries_per_label, len(vectors)), replace=False)
+        queries[meta["label"]] = (vectors[rows], [meta["names"][i] for i in rows])
+    return corpus, queries
+
+
+# -------------------------
+# Evaluation
+# -------------------------
+def shorten(vectors, dimensions):
+    return normalise_rows(np.ascontiguousarray(vectors[:, :dimensions]))
+
+
+def evaluate(corpus, queries, profiles, top_k):
+    """Recall@k of each (dimensions, dtype) profile against the first profile, which must be exact."""
+    results = []
+    baseline = {}
+    for dimensions, dtype in profiles:
+        snapshot_dir = os.path.join(SCRATCH, f"profile_{dimensions}_{dtype}")
+        index = LocalVectorIndex(snapshot_dir, max_age_seconds=float("inf"))
+        recalls, timings = [], []
+        snapshot_bytes = graph_bytes = 0
+        for label, (names, vectors) in corpus.items():
+            meta = write_snapshot(snapshot_dir, label, names, shorten(vectors, dimensions),
+                                  ivf_min_size=len(names) + 1, dtype=dtype)
+            snapshot_bytes += sum(os.path.getsize(os.path.join(snapshot_dir, meta[key]))
+                                  for key in ("vectors", "scales") if meta[key])
+            graph_bytes += len(names) * dimensions * 8
+
+            query_vectors, exclude = queries[label]
+            start = time.perf_counter()
+            # One extra hit so a query sampled from the label can drop itself
+            hits = index.search_many(label, shorten(query_vectors, dimensions), top_k + 1)
+            timings.append((time.perf_counter() - start) * 1000 / max(len(query_vectors), 1))
+            for query_id, (ranked, own_name) in enumerate(zip(hits, exclude)):
+                top = [name for name, _ in ranked if name != own_name][:top_k]
+                expected = baseline.setdefault((label, query_id), top)
+                if expected:
+                    recalls.append(len(set(top) & set(expected)) / len(expected))
+        results.append({"dimensions": dimensions, "dtype": dtype,
+                        f"recall@{top_k}": round(statistics.mean(recalls), 4),
+                        "snapshot_mb": round(snapshot_bytes / 2 ** 20, 3),
+                        "neo4j_vector_mb": round(graph_bytes / 2 ** 20, 3),
+                        "search_ms_per_query": round(statistics.mean(timings), 3)})
+    full = results[0]
+    for result in results:
+        result["snapshot_saved"] = round(1 - result["snapshot_mb"] / full["snapshot_mb"], 4)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--snapshot-dir", help="Full-size float32 snapshots to evaluate instead of the offline corpus")
+    parser.add_argument("--rawdata", default=os.path.join(ROOT, "data", "rawdata"))
+    parser.add_argument("--queries", default=os.path.join(ROOT, "benchmarks", "retrieval_queries.json"))
+    parser.add_argument("--queries-per-label", type=int, default=200)
+    parser.add_argument("--model-dimensions", type=int, default=MODEL_DIMENSIONS.get(EMBEDDING_MODEL, 1536),
+                        help="Native size of the offline stand-in vectors")
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[1024, 512, 256])
+    parser.add_argument("--dtypes", nargs="+", default=list(SNAPSHOT_DTYPES), choices=SNAPSHOT_DTYPES)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--output", help="Write the results as JSON")
+    args = parser.parse_args()
+
+    if args.snapshot_dir:
+        corpus, queries = snapshot_corpus(args.snapshot_dir, args.queries_per_label)
+    else:
+        corpus, queries = offline_corpus(args.rawdata, args.queries, args.model_dimensions)
+    native = min(vectors.shape[1] for _, vectors in corpus.values())
+    sizes = [native] + sorted({d for d in args.dimensions if d < native}, reverse=True)
+    profiles = [(native, "float32")] + [(d, dtype) for d in sizes for dtype in args.dtypes
+                                        if (d, dtype) != (native, "float32")]
+    results = evaluate(corpus, queries, profiles, args.top_k)
+
+    print(f"{'dimensions':>10} {'dtype':>8} {'recall@' + str(args.top_k):>10} {'snapshot MB':>12} "
+          f"{'saved':>7} {'neo4j MB':>9} {'ms/query':>9}")
+    for result in results:
+        print(f"{result['dimensions']:>10} {result['dtype']:>8} {result[f'recall@{args.top_k}']:>10.4f} "
+              f"{result['snapshot_mb']:>12.3f} {result['snapshot_saved']:>7.1%} {result['neo4j_vector_mb']:>9.3f} "
+              f"{result['search_ms_per_query']:>9.3f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"commit": git_commit(), "source": args.snapshot_dir or "offline", "top_k": args.top_k,
+                       "nodes": sum(len(names) for names, _ in corpus.values()), "profiles": results}, file, indent=2)
+        print(f"results written to {args.output}")
@@ -0,0 +1,62 @@
+"""
+Ingestion write-path throughput: nodes per second for the per-query writer vs the
+plan-then-write (UNWIND) writer.
+
+Both writers receive the same plans, built from the extracted component files. The graph is
+wiped before each pass so both measure the same amount of work, so point NEO4J at a scratch
+database and pass --scratch to confirm.
+
+    python benchmarks/ingestion_throughput.py data/rawdata --scratch
+"""
+import argparse
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data.clients import get_driver, close_clients  # noqa: E402
+from data.data_ingestion import data_ingestor  # noqa: E402
+
+
+def load_plans(folder_path):
+    plans = []
+    for file_name in sorted(os.listdir(folder_path)):
+        with open(os.path.join(folder_path, file_name), "r", encoding="utf-8") as file:
+            root = ET.fromstring(data_ingestor.clean_xml(file.read()))
+        component_name = file_name.replace("_extracted.tsx", "").replace(".tsx", "").lower()
+        plans.append(data_ingestor.build_ingestion_plan(root, component_name))
+    return plans
+
+
+def wipe_graph():
+    with get_driver().session() as session:
+        session.run("MATCH (n) DETACH DELETE n").consume()
+    data_ingestor._base_nodes_merged = False
+
+
+def run_pass(name, apply, plans):
+    wipe_graph()
+    nodes = sum(data_ingestor.plan_node_count(plan) for plan in plans)
+    start = time.perf_counter()
+    for plan in plans:
+        apply(plan)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12} {nodes:>8} nodes  {elapsed:>8.2f}s  {nodes / elapsed:>10.1f} nodes/s")
+    return nodes / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", help="Folder of extracted component files")
+    parser.add_argument("--scratch", action="store_true", help="Confirm the target database may be wiped")
+    args = parser.parse_args()
+    if not args.scratch:
+        sys.exit("Refusing to run without --scratch: each pass deletes every node in the database.")
+
+    plans = load_plans(args.folder)
+    before = run_pass("per-query", data_ingestor.apply_ingestion_plan_per_query, plans)
+    after = run_pass("plan+unwind", data_ingestor.apply_ingestion_plan, plans)
+    print(f"speed-up: {after / before:.1f}x")
+    close_clients()
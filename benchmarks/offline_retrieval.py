@@ -0,0 +1,330 @@
+"""
+Offline retrieval benchmark: latency and quality of retrieve_data + process_top_nodes without
+Neo4j or OpenAI.
+
+The graph is built from the extracted component files through build_ingestion_plan and held in
+memory. OpenAI is replaced by a stand-in client: embeddings are deterministic hashed bag-of-words
+and character-trigram vectors, chat completions return a fixed answer. Dense search runs on the
+local vector snapshots (VECTOR_ENGINE=local), sparse search on the BM25 index (SPARSE_ENGINE=bm25),
+and graph expansion through the real get_related_nodes against a stand-in driver that answers its
+queries from the in-memory graph, so every run over the same tree gives the same ranking.
+
+Each labelled query lists substrings of the node names that answer it. Reported per run:
+p50/p95 per stage, recall@k and MRR over the retrieve_data ranking, and context recall over the
+expanded context. Stages: embed_cold (a query the embedding cache has not seen: both cache tiers
+miss, the stand-in embeds and the result is stored; OpenAI's own latency is not included),
+embed_cached (the same query again, served from the cache), retrieve, expand (no Neo4j round trip,
+see InMemoryDriver) and answer. Results are written as JSON; pass the
+previous file with --compare to print the deltas.
+
+    python benchmarks/offline_retrieval.py --output offline_retrieval.json --compare previous.json
+"""
+import argparse
+import atexit
+import glob
+import hashlib
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from types import SimpleNamespace
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Caches, snapshots and the BM25 index live in a scratch directory, never in the real .cache
+SCRATCH = tempfile.mkdtemp(prefix="offline_retrieval_")
+atexit.register(shutil.rmtree, SCRATCH, ignore_errors=True)
+os.environ.update({
+    "VECTOR_ENGINE": "local",
+    "SPARSE_ENGINE": "bm25",
+    "RETRIEVAL_MODE": "fanout",
+    "VECTOR_SNAPSHOT_DIR": os.path.join(SCRATCH, "vector_snapshots"),
+    "SPARSE_INDEX_PATH": os.path.join(SCRATCH, "sparse_index.pkl"),
+    "EMBEDDING_CACHE_PATH": os.path.join(SCRATCH, "query_embeddings.sqlite3"),
+    "GRAPH_VERSION_PATH": os.path.join(SCRATCH, "graph_version"),
+})
+
+from data.constants import problem_context_doc, schema_description  # noqa: E402
+from data.data_ingestion.data_ingestor import clean_xml, build_ingestion_plan  # noqa: E402
+from data.retriever import hybrid_retriever  # noqa: E402
+from data.retriever.sparse_index import BM25Index, tokenize  # noqa: E402
+from data.retriever.vector_index import write_snapshot  # noqa: E402
+
+STAGES = ("embed_cold", "embed_cached", "retrieve", "expand", "answer")
+
+
+# -------------------------
+# Deterministic stand-ins
+# -------------------------
+def hashed_embedding(text, dimensions=256):
+    """Signed feature hashing of word tokens and character trigrams, L2-normalised."""
+    vector = np.zeros(dimensions, dtype=np.float32)
+    tokens = tokenize(text)
+    features = tokens + [f"#{token[i:i + 3]}" for token in tokens for i in range(max(len(token) - 2, 1))]
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        index = int.from_bytes(digest[:4], "little") % dimensions
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+class StubOpenAI:
+    """Just enough of the OpenAI client surface used by hybrid_retriever."""
+
+    def __init__(self, dimensions):
+        def create_embeddings(input, model, **kwargs):
+            texts = [input] if isinstance(input, str) else input
+            return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=hashed_embedding(text, dimensions))
+                                         for i, text in enumerate(texts)])
+
+        def create_completion(model, messages, stream=False, **kwargs):
+            prompt = messages[-1]["content"]
+            answer = f"Stub answer ({len(prompt)} prompt characters)."
+            usage = SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(answer) // 4)
+            if stream:
+                return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word))],
+                                             usage=None) for word in answer.split(" ")]
+                            + [SimpleNamespace(choices=[], usage=usage)])
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=answer))], usage=usage)
+
+        self.embeddings = SimpleNamespace(create=create_embeddings)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create_completion))
+
+
+class InMemoryGraph:
+    """Problem → child edges as written by write_ingestion_plan, with the context documents it stores."""
+
+    def __init__(self):
+        self.nodes = {}
+        self.children = {}
+        self.parents = {}
+        # Creation order stands in for Neo4j node ids, which order the children within a label
+        self.ids = {}
+
+    def apply_plan(self, plan):
+        self.nodes.setdefault("Component", set()).add(plan["component"])
+        for node in plan["component_nodes"]:
+            self.nodes.setdefault(node["label"], set()).add(node["name"])
+        for problem in plan["problems"]:
+            self.nodes.setdefault("Problem", set()).add(problem)
+        if plan["parent_problem"]:
+            self.nodes["Problem"].add(plan["parent_problem"])
+            for problem in plan["problems"]:
+                self._link(plan["parent_problem"], "Problem", problem)
+        for child in plan["problem_children"]:
+            self.nodes.setdefault(child["label"], set()).add(child["name"])
+            self._link(child["problem"], child["label"], child["name"])
+
+    def _link(self, problem, label, name):
+        edges = self.children.setdefault(problem, [])
+        if (label, name) not in edges:
+            self.ids.setdefault((label, name), len(self.ids))
+            edges.append((label, name))
+            self.parents.setdefault(name, []).append((label, problem))
+
+    def context_doc(self, problem):
+        """The problem's `context_doc` as CONTEXT_DOC_UPDATE writes it: children by label, then by id."""
+        return [f"{label}: {name}" for label, name in
+                sorted(self.children.get(problem, []), key=lambda edge: (edge[0], self.ids[edge]))]
+
+
+class InMemoryDriver:
+    """
+    Stand-in for the Neo4j driver that answers the two get_related_nodes queries from an
+    InMemoryGraph, so expansion runs through the real get_related_nodes. Any other query raises.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def session(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def run(self, query, node_name):
+        if problem_context_doc("problem") not in query:
+            raise NotImplementedError(f"offline benchmark cannot run: {query}")
+        if "MATCH (problem:Problem {name: $node_name})" in query:
+            problems = [node_name] if node_name in self.graph.children else []
+        else:
+            label = next((label for label in schema_description if f"(child:{label} " in query), None)
+            problems = [problem for child_label, problem in self.graph.parents.get(node_name, [])
+                        if label is None or child_label == label]
+        return [{"doc": self.graph.context_doc(problem)} for problem in problems]
+
+
+def load_graph(folder):
+    graph = InMemoryGraph()
+    for path in sorted(glob.glob(os.path.join(folder, "*"))):
+        with open(path, "r", encoding="utf-8") as file:
+            root = ET.fromstring(clean_xml(file.read()))
+        component_name = os.path.basename(path).replace("_extracted.tsx", "").replace(".tsx", "").lower()
+        graph.apply_plan(build_ingestion_plan(root, component_name))
+    return graph
+
+
+def build_environment(folder, dimensions):
+    graph = load_graph(folder)
+    bm25 = BM25Index()
+    for label, names in graph.nodes.items():
+        names = sorted(names)
+        for name in names:
+            bm25.add(label, name)
+        write_snapshot(os.environ["VECTOR_SNAPSHOT_DIR"], label, names,
+                       np.array([hashed_embedding(name, dimensions) for name in names], dtype=np.float32),
+                       ivf_min_size=50000)
+    bm25.save(os.environ["SPARSE_INDEX_PATH"])
+
+    hybrid_retriever.get_openai_client = lambda: StubOpenAI(dimensions)
+    hybrid_retriever.get_driver = lambda: InMemoryDriver(graph)
+    return graph
+
+
+# -------------------------
+# Metrics
+# -------------------------
+def matches(name, relevant):
+    return relevant in name.lower()
+
+
+def score_query(item, results, content):
+    names = [result["name"] for result in results]
+    found = [r for r in item["relevant"] if any(matches(name, r) for name in names)]
+    rank = next((i + 1 for i, name in enumerate(names) if any(matches(name, r) for r in item["relevant"])), None)
+    in_context = [r for r in item["relevant"] if any(r in line.lower() for line in content)]
+    return {"recall": len(found) / len(item["relevant"]), "reciprocal_rank": 1 / rank if rank else 0.0,
+            "context_recall": len(in_context) / len(item["relevant"])}
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def run(queries, repeat):
+    timings = {stage: [] for stage in STAGES}
+    per_query = []
+    searched_labels = []
+    select_labels = hybrid_retriever.select_labels
+
+    def counting_select_labels(query_vector):
+        labels = select_labels(query_vector)
+        searched_labels.append(len(labels))
+        return labels
+
+    hybrid_retriever.select_labels = counting_select_labels
+    for round_index in range(repeat):
+        for item in queries:
+            query = item["query"]
+            # A spelling of the query no earlier round has embedded, for the cache-miss path
+            cold_query = f"{query} (round {round_index})"
+            start = time.perf_counter()
+            hybrid_retriever.get_openai_embedding(cold_query)
+            embedded_cold = time.perf_counter()
+            hybrid_retriever.get_openai_embedding(cold_query)
+            embedded = time.perf_counter()
+            results = hybrid_retriever.retrieve_data(query)
+            retrieved = time.perf_counter()
+            content = hybrid_retriever.process_top_nodes(results)
+            expanded = time.perf_counter()
+            hybrid_retriever.final_call(query, content)
+            answered = time.perf_counter()
+            for stage, elapsed in zip(STAGES, (embedded_cold - start, embedded - embedded_cold,
+                                               retrieved - embedded, expanded - retrieved, answered - expanded)):
+                timings[stage].append(elapsed * 1000)
+            if round_index == 0:
+                per_query.append({"query": query, "retrieved": [r["name"] for r in results],
+                                  **score_query(item, results, content)})
+
+    latency = {stage: {"p50_ms": round(statistics.median(values), 3), "p95_ms": round(percentile(values, 0.95), 3)}
+               for stage, values in timings.items()}
+    quality = {
+        f"recall@{hybrid_retriever.top_k}": round(statistics.mean(q["recall"] for q in per_query), 4),
+        "mrr": round(statistics.mean(q["reciprocal_rank"] for q in per_query), 4),
+        "context_recall": round(statistics.mean(q["context_recall"] for q in per_query), 4),
+        "labels_per_query": round(statistics.mean(searched_labels), 2),
+    }
+    return latency, quality, per_query
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_comparison(current, previous_path):
+    with open(previous_path, "r", encoding="utf-8") as file:
+        previous = json.load(file)
+    print(f"\nvs {previous_path} (commit {previous.get('commit')}):")
+    for stage in STAGES:
+        if stage not in previous["latency"]:
+            continue
+        for key in ("p50_ms", "p95_ms"):
+            before, after = previous["latency"][stage][key], current["latency"][stage][key]
+            print(f"  {stage:<12}{key:<8}{before:>10.3f} -> {after:>10.3f}")
+    for key, after in current["quality"].items():
+        before = previous["quality"].get(key)
+        flag = "  REGRESSION" if before is not None and after < before else ""
+        print(f"  {key:<17}{before if before is not None else '-':>10} -> {after:>10}{flag}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rawdata", default=os.path.join(ROOT, "data", "rawdata"))
+    parser.add_argument("--queries", default=os.path.join(ROOT, "benchmarks", "retrieval_queries.json"))
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--top-k", type=int, default=hybrid_retriever.top_k)
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Vector similarity cutoff; hashed embeddings score lower than OpenAI ones")
+    parser.add_argument("--label-routing", default=hybrid_retriever.label_routing, choices=("centroid", "fixed"))
+    parser.add_argument("--output", default="offline_retrieval.json")
+    parser.add_argument("--compare", help="Previous results file to diff against")
+    args = parser.parse_args()
+
+    hybrid_retriever.top_k = args.top_k
+    hybrid_retriever.threshold = args.threshold
+    hybrid_retriever.label_routing = args.label_routing
+    graph = build_environment(args.rawdata, args.dimensions)
+    with open(args.queries, "r", encoding="utf-8") as file:
+        queries = json.load(file)
+
+    latency, quality, per_query = run(queries, args.repeat)
+    report = {
+        "commit": git_commit(),
+        "config": {"top_k": args.top_k, "threshold": args.threshold, "alpha": hybrid_retriever.alpha,
+                   "dimensions": args.dimensions, "repeat": args.repeat, "label_routing": args.label_routing, "queries": len(queries),
+                   "nodes": sum(len(names) for names in graph.nodes.values()),
+                   "expand_graph": "in-memory stand-in for Neo4j"},
+        "latency": latency,
+        "quality": quality,
+        "per_query": per_query,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+
+    for stage in STAGES:
+        print(f"{stage:<12} p50 {latency[stage]['p50_ms']:>8.3f} ms   p95 {latency[stage]['p95_ms']:>8.3f} ms")
+    print("(expand reads context documents from the in-memory graph, not Neo4j: no round trip is timed)")
+    for key, value in quality.items():
+        print(f"{key:<15} {value}")
+    print(f"results written to {args.output}")
+    if args.compare:
+        print_comparison(report, args.compare)
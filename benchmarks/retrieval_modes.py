@@ -0,0 +1,41 @@
+"""
+Compare retrieval latency of the fan-out path (retrieve_data + process_top_nodes) with the
+single-round-trip Cypher path against the configured Neo4j database.
+
+    python benchmarks/retrieval_modes.py "AC not cooling" "engine oil leak" --repeat 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data.retriever import hybrid_retriever  # noqa: E402
+
+
+def time_mode(mode, queries, repeat):
+    timings = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            hybrid_retriever.retrieve_context(query, mode=mode)
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("queries", nargs="+")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # Warm the embedding cache so both modes measure retrieval only
+    for query in args.queries:
+        hybrid_retriever.get_openai_embedding(query)
+
+    for mode in ("fanout", "single"):
+        timings = time_mode(mode, args.queries, args.repeat)
+        print(f"{mode:<8} p50 {statistics.median(timings):8.1f} ms   "
+              f"max {max(timings):8.1f} ms   n={len(timings)}")
@@ -0,0 +1,60 @@
+"""
+App startup cost: time to `import app` and to serve the first request, measured in fresh
+interpreters so module-level setup is paid on every run.
+
+Importing the app must not open Neo4j connections or require retrieval settings, so each run
+clears NEO4J_* / top_k / threshold / alpha and reports whether a driver was created.
+--warm additionally times data.clients.warm_pool() against the configured database.
+
+    python benchmarks/startup_time.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get('/login')
+served = time.perf_counter()
+from data import clients
+result = {"import_ms": (imported - start) * 1000, "first_request_ms": (served - imported) * 1000,
+          "driver_created": clients._driver is not None}
+if WARM:
+    warm_start = time.perf_counter()
+    result["warm_ok"] = clients.warm_pool()
+    result["warm_ms"] = (time.perf_counter() - warm_start) * 1000
+print(json.dumps(result))
+"""
+
+
+def run_once(warm):
+    env = dict(os.environ, SECRET_KEY=os.getenv("SECRET_KEY", "startup-benchmark"),
+               SQLALCHEMY_DATABASE_URI=os.getenv("SQLALCHEMY_DATABASE_URI", "sqlite://"))
+    if not warm:
+        for name in ("NEO4J_URI", "NEO4J_USERNAME", "NEO4J_PASSWORD", "top_k", "threshold", "alpha"):
+            env.pop(name, None)
+    output = subprocess.run([sys.executable, "-c", f"WARM = {warm}\n{PROBE}"], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warm", action="store_true", help="Also time warm_pool() against NEO4J_URI")
+    args = parser.parse_args()
+
+    runs = [run_once(args.warm) for _ in range(args.runs)]
+    for key in ("import_ms", "first_request_ms", "warm_ms"):
+        values = [run[key] for run in runs if key in run]
+        if values:
+            print(f"{key:<18} median {statistics.median(values):>8.1f}  max {max(values):>8.1f}")
+    print(f"driver created at import: {any(run['driver_created'] for run in runs)}")
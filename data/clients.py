@@ -0,0 +1,89 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+# -------------------------
+# Shared Neo4j / OpenAI clients, created on first use
+# -------------------------
+load_dotenv()
+
+NEO4J_MAX_POOL_SIZE = int(os.getenv("NEO4J_MAX_POOL_SIZE", "50"))
+NEO4J_MAX_CONNECTION_LIFETIME = int(os.getenv("NEO4J_MAX_CONNECTION_LIFETIME", "3600"))
+NEO4J_ACQUISITION_TIMEOUT = float(os.getenv("NEO4J_ACQUISITION_TIMEOUT", "60"))
+NEO4J_WARM_CONNECTIONS = int(os.getenv("NEO4J_WARM_CONNECTIONS", "4"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+_lock = threading.Lock()
+_driver = None
+_openai_client = None
+
+
+def get_driver():
+    """Process-wide Neo4j driver; importing a module that uses it does no network setup."""
+    global _driver
+    if _driver is None:
+        with _lock:
+            if _driver is None:
+                from neo4j import GraphDatabase
+                _driver = GraphDatabase.driver(
+                    os.getenv("NEO4J_URI", "bolt://localhost:7687"),
+                    auth=(os.getenv("NEO4J_USERNAME", "neo4j"), os.getenv("NEO4J_PASSWORD")),
+                    max_connection_pool_size=NEO4J_MAX_POOL_SIZE,
+                    max_connection_lifetime=NEO4J_MAX_CONNECTION_LIFETIME,
+                    connection_acquisition_timeout=NEO4J_ACQUISITION_TIMEOUT
+                )
+    return _driver
+
+
+def get_openai_client():
+    """Process-wide OpenAI client sharing one HTTP connection pool."""
+    global _openai_client
+    if _openai_client is None:
+        with _lock:
+            if _openai_client is None:
+                import openai
+                _openai_client = openai.OpenAI(
+                    api_key=os.getenv("OPENAI_API_KEY"),
+                    timeout=OPENAI_TIMEOUT,
+                    max_retries=OPENAI_MAX_RETRIES
+                )
+    return _openai_client
+
+
+def warm_pool(connections=NEO4J_WARM_CONNECTIONS):
+    """
+    Open `connections` pooled Neo4j connections up front (e.g. from a gunicorn post_worker_init hook)
+    so the first requests of a worker do not pay for TCP, TLS and auth.
+    """
+    driver = get_driver()
+    try:
+        driver.verify_connectivity()
+        if connections > 1:
+            # Concurrent sessions force distinct connections; they return to the pool when closed
+            barrier = threading.Barrier(connections)
+
+            def hold_connection():
+                with driver.session() as session:
+                    session.run("RETURN 1").consume()
+                    barrier.wait(timeout=NEO4J_ACQUISITION_TIMEOUT)
+
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                for future in [executor.submit(hold_connection) for _ in range(connections)]:
+                    future.result()
+        get_openai_client()
+        return True
+    except Exception as e:
+        print(f"Connection pool warm-up error: {e}")
+        return False
+
+
+def close_clients():
+    global _driver, _openai_client
+    with _lock:
+        if _driver is not None:
+            _driver.close()
+        if _openai_client is not None:
+            _openai_client.close()
+        _driver, _openai_client = None, None
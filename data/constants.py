@@ -20,6 +20,20 @@ fulltext_index_names = {
     label: f"search_{label}" for label in schema_description
 }
 
+# Relationships from a Problem to the nodes that make up its context
+problem_context_rel_types = ("HAS_PROCEDURES|HAS_SUBCOMPONENT|HAS_TESTPROCEDURES|HAS_SUBPROBLEM"
+                             "|HAS_ADDITIONALINFO|HAS_SYMPTOM|HAS_SUSPECTAREA|HAS_BASICINFO")
+
+
+def problem_context_doc(problem):
+    """
+    Cypher expression for a Problem's context document: the "<Label>: <name>" lines of its children,
+    grouped by label. Ingestion stores it as `context_doc`; problems written before that fall back
+    to reading the children.
+    """
+    return (f"coalesce({problem}.context_doc, "
+            f"[({problem})-[:{problem_context_rel_types}]->(c) | labels(c)[0] + ': ' + c.name])")
+
 
 tag_to_label_map =  {
     "AdditionalInfo": ["additional_info", "junction_block", "maintenance", "parts", "parts_location", "precaution",
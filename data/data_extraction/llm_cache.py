@@ -0,0 +1,97 @@
+import os
+import hashlib
+import threading
+
+
+# -------------------------
+# Content-addressed, file-backed cache for LLM output
+# -------------------------
+class LLMCache:
+    """
+    Stores one file per LLM response, named by a hash of (model, prompt template, chunk text).
+
+    Reads refresh a file's mtime, so when the directory grows past `max_bytes` the least
+    recently used entries are evicted first.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def make_key(chunk, prompt_template, model):
+        digest = hashlib.sha256()
+        for part in (model or "", prompt_template, chunk):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _entries(self):
+        for dir_path, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                # Skip other writers' in-progress temp files; they become entries once replaced
+                if file_name.endswith(".tmp"):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                value = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(value)
+        size = os.path.getsize(tmp_path)
+        replaced = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size += size - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache is back under 90% of its budget
+        target = int(self.max_bytes * 0.9)
+        for path, size, _ in sorted(self._entries(), key=lambda entry: entry[2]):
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except FileNotFoundError:
+                pass
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"LLM cache: {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)"
@@ -1,33 +1,26 @@
 import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 import PyPDF2
-import openai
+
+from data.clients import get_openai_client
+from data.data_extraction.llm_cache import LLMCache
 
 load_dotenv()
 
-openai.api_key = os.getenv('OPENAI_API_KEY')
 model = os.getenv('MODEL')
 
+MAX_CHUNK_SIZE = 5000
+PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', '16'))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '3'))
+LLM_CACHE_DIR = os.getenv('LLM_CACHE_DIR', '.llm_cache')
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
 
-def extract_pdf_content(pdf_path):
-    content = []
-    with open(pdf_path, 'rb') as file:
-        reader = PyPDF2.PdfReader(file)
-        for page in reader.pages:
-            content.append(page.extract_text())
-    return "\n".join(content)
-
-
-def structure_content_with_llm(text):
-    all_structured_data = []
-    try:
-        max_chunk_size = 5000
-        chunks = [text[i:i + max_chunk_size] for i in range(0, len(text), max_chunk_size)]
-
-        # Process each chunk individually
-        for chunk in chunks:
-            # prompt for each chunk
-            prompt = f"""
+STRUCTURING_PROMPT = """
             You are a car mechanic guide. Extract and structure the following information into suitable categories such as:
             - Problem
             - Symptom
@@ -55,18 +48,164 @@ def structure_content_with_llm(text):
             Also extract the details of the car such as model number, type, manufacturer etc.., if available with suitable tags else do not include these tags.
             """
 
-            response = openai.chat.completions.create(
+llm_cache = LLMCache(LLM_CACHE_DIR, LLM_CACHE_MAX_BYTES)
+
+
+def extract_pdf_content(pdf_path):
+    content = []
+    with open(pdf_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        for page in reader.pages:
+            content.append(page.extract_text())
+    return "\n".join(content)
+
+
+def count_pdf_pages(pdf_path):
+    with open(pdf_path, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
+
+def extract_page_range(pdf_path, start, stop):
+    """Extract pages [start, stop) of a PDF. Runs inside a worker process."""
+    with open(pdf_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def iter_pdf_pages(pdf_path, max_workers=None, pages_per_task=PAGES_PER_TASK):
+    """
+    Extract pages in a process pool and yield their text in page order as soon as each range is ready.
+    At most `2 * max_workers` ranges are in flight, so a slow consumer never has the whole PDF in memory.
+    """
+    page_count = count_pdf_pages(pdf_path)
+    max_workers = max_workers or os.cpu_count() or 1
+    starts = iter(range(0, page_count, pages_per_task))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        window = deque()
+        for start in starts:
+            window.append(executor.submit(extract_page_range, pdf_path, start,
+                                          min(start + pages_per_task, page_count)))
+            if len(window) >= 2 * max_workers:
+                break
+        while window:
+            pages = window.popleft().result()
+            # Refill before yielding so extraction keeps going while the consumer works
+            start = next(starts, None)
+            if start is not None:
+                window.append(executor.submit(extract_page_range, pdf_path, start,
+                                              min(start + pages_per_task, page_count)))
+            yield from pages
+
+
+def iter_chunks(pages, max_chunk_size=MAX_CHUNK_SIZE):
+    """Slice a stream of page texts into the same chunks as slicing "\\n".join(pages)."""
+    buffer = None
+    for page in pages:
+        buffer = page if buffer is None else buffer + "\n" + page
+        while len(buffer) >= max_chunk_size:
+            yield buffer[:max_chunk_size]
+            buffer = buffer[max_chunk_size:]
+    if buffer:
+        yield buffer
+
+
+def structure_chunk(chunk, max_retries=LLM_MAX_RETRIES):
+    """
+    Structure one chunk with the LLM, retrying with exponential backoff before giving up.
+    Responses are cached by chunk text, prompt template and model, so unchanged chunks cost nothing.
+    """
+    cache_key = LLMCache.make_key(chunk, STRUCTURING_PROMPT, model)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    for attempt in range(max_retries + 1):
+        try:
+            # Retries are handled here with backoff, so the client's own retries are switched off
+            response = get_openai_client().with_options(max_retries=0).chat.completions.create(
                 model=model,
-                messages=[{"role": "user", "content": prompt}]
+                messages=[{"role": "user", "content": STRUCTURING_PROMPT.format(chunk=chunk)}]
             )
+            structured_output = response.choices[0].message.content.strip()
+            break
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            print(f"⚠️ LLM call failed (attempt {attempt + 1}/{max_retries + 1}): {e}")
+            time.sleep(2 ** attempt)
+
+    # Outside the retry loop: a failed cache write must not pay for another LLM call
+    try:
+        llm_cache.put(cache_key, structured_output)
+    except OSError as e:
+        print(f"⚠️ Could not cache LLM output: {e}")
+    return structured_output
+
+
+def structure_content_with_llm(text):
+    all_structured_data = []
+    llm_cache.reset_stats()
+    max_chunk_size = MAX_CHUNK_SIZE
+    chunks = [text[i:i + max_chunk_size] for i in range(0, len(text), max_chunk_size)]
+
+    # Process each chunk individually
+    for index, chunk in enumerate(chunks):
+        try:
+            structured_output = structure_chunk(chunk)
+        except Exception as e:
+            print(f"❌ Chunk {index} failed after retries: {e}")
+            continue
+
+        if structured_output:
+            all_structured_data.append(structured_output)
+
+    print(llm_cache.report())
+    return "\n".join(all_structured_data)
+
+
+def structure_pdf_pipeline(pdf_path, max_workers=None, max_concurrency=LLM_MAX_CONCURRENCY,
+                           max_retries=LLM_MAX_RETRIES):
+    """
+    Stream a PDF through page extraction and LLM structuring.
+
+    Pages are extracted in a process pool, chunks are structured as soon as they are available
+    with at most `max_concurrency` LLM calls in flight, and the output is reassembled in chunk
+    order. Returns the structured text and the indices of chunks that failed after retries.
+    """
+    results = {}
+    failed_chunks = []
+
+    def collect(done):
+        for future in done:
+            index = in_flight.pop(future)
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                failed_chunks.append(index)
+                print(f"❌ Chunk {index} failed after {max_retries + 1} attempts: {e}")
+
+    in_flight = {}
+    llm_cache.reset_stats()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        chunks = iter_chunks(iter_pdf_pages(pdf_path, max_workers=max_workers))
+        for index, chunk in enumerate(chunks):
+            # Keep only a bounded number of chunks queued so pages are not all held in memory
+            if len(in_flight) >= 2 * max_concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[executor.submit(structure_chunk, chunk, max_retries)] = index
+        collect(wait(in_flight).done)
 
-            # print(response)
-            structured_output = response.choices[0].message.content
+    structured = "\n".join(results[index] for index in sorted(results) if results[index])
+    print(f"✅ Structured {len(results)} chunks, {len(failed_chunks)} failed")
+    print(llm_cache.report())
+    return structured, sorted(failed_chunks)
 
-            if structured_output.strip():
-                all_structured_data.append(structured_output.strip())
 
-    except:
-        pass
-    finally:
-        return "\n".join(all_structured_data)
\ No newline at end of file
+if __name__ == "__main__":
+    pdf_path, output_path = sys.argv[1], sys.argv[2]
+    structured, failed_chunks = structure_pdf_pipeline(pdf_path)
+    with open(output_path, "w", encoding="utf-8") as file:
+        file.write(structured)
+    if failed_chunks:
+        print(f"⚠️ Re-run needed for chunks: {failed_chunks}")
@@ -1,43 +1,217 @@
 import os
 import re
+import glob
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import threading
 import xml.etree.ElementTree as ET
-from dotenv import load_dotenv
-from neo4j import GraphDatabase
+from lxml import etree
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from tqdm import tqdm
 
 # --------------------------
 # Map rawdata XML tags to graph node labels
 # --------------------------
-from constants import tag_to_label_map
+from data.constants import tag_to_label_map, problem_context_rel_types
+from data.clients import get_driver, close_clients, NEO4J_MAX_POOL_SIZE
+from data.retriever.sparse_index import SparseIndexStore
+from data.graph_version import bump_graph_version
 
-# --------------------------
-# Load credentials from .env file
-# --------------------------
-load_dotenv()
-# uri = os.getenv("NEO4J_URI")
-# username = os.getenv("NEO4J_USERNAME")
-# password = os.getenv("NEO4J_PASSWORD")
-uri = "bolt://localhost:7687"  # Use "neo4j://localhost:7687" if needed
-username = "neo4j"
-password = "Padma@8099"
-driver = GraphDatabase.driver(uri, auth=(username, password))
+# Local BM25 index used by the retriever; kept in step with newly ingested nodes
+sparse_index_store = SparseIndexStore(os.getenv("SPARSE_INDEX_PATH", ".cache/sparse_index.pkl"))
+INGEST_MANIFEST_PATH = os.getenv("INGEST_MANIFEST_PATH", ".cache/ingest_manifest.json")
+# "stream" parses top-level elements one at a time; "tree" parses the whole document at once
+INGEST_XML_PARSER = os.getenv("INGEST_XML_PARSER", "stream")
+XML_CHUNK_SIZE = int(os.getenv("XML_CHUNK_SIZE", str(1 << 16)))
+# Concurrent component writes; each holds one pooled Neo4j session
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS") or min(os.cpu_count() or 4, NEO4J_MAX_POOL_SIZE))
+# Processes building plans for the writers; parsing is CPU-bound
+INGEST_PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS") or os.cpu_count() or 4)
+INGEST_RETRY_PATH = os.getenv("INGEST_RETRY_PATH", ".cache/ingest_retry.txt")
 
 
 # --------------------------
 # Clean malformed XML safely
 # --------------------------
+def clean_fragment(xml_content):
+    xml_content = re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]', '', xml_content)
+    xml_content = re.sub(r'&(?!amp;|lt;|gt;|quot;|apos;)', '&amp;', xml_content)
+    if xml_content.startswith("\ufeff"):
+        xml_content = xml_content.lstrip("\ufeff")
+    return re.sub(r'<(\d+–\d+)>', r'(\1)', xml_content)
+
+
 def clean_xml(xml_content):
     try:
-        xml_content = re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]', '', xml_content)
-        xml_content = re.sub(r'&(?!amp;|lt;|gt;|quot;|apos;)', '&amp;', xml_content)
-        if xml_content.startswith("\ufeff"):
-            xml_content = xml_content.lstrip("\ufeff")
-        xml_content = re.sub(r'<(\d+–\d+)>', r'(\1)', xml_content)
-        return f"<root>{xml_content}</root>"
+        return f"<root>{clean_fragment(xml_content)}</root>"
     except Exception as e:
         print(f"❌ Error cleaning XML content: {e}")
         return xml_content
 
 
+# --------------------------
+# Stream top-level elements out of a component file
+# --------------------------
+# A start/end/empty tag (attribute values may contain ">"), or the "<!" / "<?" opening a comment,
+# CDATA section, processing instruction or declaration, whose extent is found separately
+TAG_PATTERN = r'(?:[^<>"\']|"[^"<]*"|\'[^\'<]*\')*>'
+TOP_LEVEL_TAG = re.compile(r'<[!?]|<(/?)([A-Za-z_][\w.\-]*)' + TAG_PATTERN)
+INCOMPLETE_TAG = re.compile(r'</?[A-Za-z_]')
+SPECIAL_MARKUP = (("<!--", "-->"), ("<![CDATA[", "]]>"), ("<?", "?>"), ("<!", ">"))
+
+# Stands in for a <problem> that could not be parsed, so the elements after it are dropped
+# instead of being attached to the previous problem
+SKIPPED_PROBLEM = ET.Element("problem")
+
+
+def read_chunks(file, size=XML_CHUNK_SIZE):
+    return iter(lambda: file.read(size), "")
+
+
+def special_markup_end(buffer, index, final):
+    """End of the comment/CDATA/PI/declaration starting at `index`; None if it continues in the next chunk."""
+    for opener, closer in SPECIAL_MARKUP:
+        if buffer.startswith(opener, index):
+            end = buffer.find(closer, index + len(opener))
+            if end != -1:
+                return end + len(closer)
+            return len(buffer) if final else None
+
+
+def element_tag_re(tag):
+    return re.compile(rf'<[!?]|<(/?){re.escape(tag)}(?=[\s/>])' + TAG_PATTERN)
+
+
+def iter_xml_fragments(chunks):
+    """
+    Split a stream of text chunks into (line, tag, text, None) for each top-level element without
+    parsing the document as a whole. An element ends at the `</tag>` balancing its opening tag, so
+    broken markup inside it cannot swallow the elements that follow; only the current element and
+    one chunk are held in memory. Comments, CDATA sections and processing instructions are skipped
+    as a whole, so tags inside them are not counted. Stray closing tags and unclosed elements come
+    back as (line, tag, None, reason), with `tag` set for unclosed elements only, and scanning
+    resumes right after them.
+    """
+    buffer = ""
+    line, counted = 1, 0        # line number at buffer[counted]
+    start, opening, tag_re, depth, scan = None, None, None, 0, 0
+
+    def line_at(index):
+        nonlocal line, counted
+        line += buffer.count("\n", counted, index)
+        counted = index
+        return line
+
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        if not final:
+            # Drop everything before the current element (or a possibly incomplete tag)
+            keep = start if start is not None else scan
+            line_at(keep)
+            buffer = buffer[keep:] + chunk
+            scan -= keep
+            counted = 0
+            if start is not None:
+                start = 0
+        while True:
+            match = (TOP_LEVEL_TAG if start is None else tag_re).search(buffer, scan)
+            if match and match.group(0) in ("<!", "<?"):
+                end = special_markup_end(buffer, match.start(), final)
+                if end is None:
+                    scan = match.start()
+                    break
+                scan = end
+                continue
+
+            if start is None:
+                if not match:
+                    # Text between elements is dropped; keep a possibly incomplete tag for the next chunk
+                    last_open = buffer.rfind("<", scan)
+                    if final and last_open != -1 and INCOMPLETE_TAG.match(buffer, last_open):
+                        yield line_at(last_open), None, None, f"incomplete tag {buffer[last_open:last_open + 40]!r}"
+                    scan = len(buffer) if last_open == -1 else last_open
+                    break
+                if match.group(1):
+                    yield line_at(match.start()), None, None, f"unexpected {match.group(0)}"
+                    scan = match.end()
+                elif match.group(0).endswith("/>"):
+                    yield line_at(match.start()), match.group(2), match.group(0), None
+                    scan = match.end()
+                else:
+                    start, opening, depth, scan = match.start(), match, 1, match.end()
+                    tag_re = element_tag_re(match.group(2))
+                continue
+
+            if match:
+                scan = match.end()
+                depth += -1 if match.group(1) else 0 if match.group(0).endswith("/>") else 1
+                if depth == 0:
+                    yield line_at(start), opening.group(2), buffer[start:scan], None
+                    start = None
+                continue
+            if final:
+                # Never closed: report it and recover the elements nested after its opening tag
+                yield line_at(start), opening.group(2), None, f"unclosed {opening.group(0)}"
+                start, scan = None, start + len(opening.group(0))
+                continue
+            last_open = buffer.rfind("<", scan)
+            scan = len(buffer) if last_open == -1 else last_open
+            break
+
+
+def fragment_parser():
+    """
+    lxml parser for single fragments. Recover mode collects every error of a fragment in its
+    error_log (with line numbers) instead of stopping at the first one; entities and network
+    access stay off because the input is LLM output.
+    """
+    return etree.XMLParser(recover=True, remove_comments=True, remove_pis=True,
+                           resolve_entities=False, no_network=True)
+
+
+def iter_xml_elements(chunks, skipped=None):
+    """
+    Parse each top-level fragment of a component on its own and yield the elements in document
+    order. Fragments with any parse error are left out and described in `skipped` (line, error);
+    a left-out <problem> is yielded as SKIPPED_PROBLEM.
+
+    Splitting is done by iter_xml_fragments rather than an lxml pull parser: with recover=True,
+    XMLPullParser silently drops everything after a stray closing tag and leaves its error_log
+    empty, so neither the damage nor the elements after it can be recovered.
+    """
+    parser = fragment_parser()
+    for line, tag, fragment, error in iter_xml_fragments(chunks):
+        if fragment is not None:
+            try:
+                element = etree.fromstring(clean_fragment(fragment), parser)
+                errors = [(entry.line, entry.message) for entry in parser.error_log
+                          if entry.level >= etree.ErrorLevels.ERROR]
+            except etree.XMLSyntaxError as e:
+                element, errors = None, [(e.lineno, e.msg)]
+            if element is not None and not errors:
+                yield element
+                continue
+            error_line, message = errors[0] if errors else (1, "no element")
+            line += (error_line or 1) - 1
+            error = f"{message} in {fragment[:60]!r}"
+        if skipped is not None:
+            skipped.append({"line": line, "error": error})
+        if tag == "problem":
+            yield SKIPPED_PROBLEM
+
+
+def component_elements(source, skipped=None):
+    """Top-level elements of a component from a string or an open text file, per INGEST_XML_PARSER."""
+    if INGEST_XML_PARSER == "tree":
+        return ET.fromstring(clean_xml(source if isinstance(source, str) else source.read()))
+    return iter_xml_elements([source] if isinstance(source, str) else read_chunks(source), skipped)
+
+
 # --------------------------
 # Recursively extract text from XML element
 # --------------------------
@@ -67,132 +241,631 @@ def get_standardized_label(tag):
 # --------------------------
 def execute_query(query, parameters=None):
     try:
-        with driver.session() as session:
+        with get_driver().session() as session:
             session.run(query, parameters or {})
     except Exception as e:
         print(f"❌ Cypher Error: {e}\nQuery: {query}\nParams: {parameters}")
 
 
 # --------------------------
-# Main function to parse and insert XML into Neo4j
+# Build an in-memory ingestion plan for one component
 # --------------------------
-def parse_and_insert_data(xml_content: str, component_name: str):
-    try:
-        xml_content = clean_xml(xml_content)
-        root = ET.fromstring(xml_content)
-
-        # Static base nodes
-        execute_query("MERGE (pg:ProductGroup {name: 'automobile'})")
-        execute_query("MERGE (man:Manufacturer {name: 'toyota motor corporation'})")
-        execute_query("MERGE (m:Model {name: 'yaris', series: 'ncp91, 93 series'})")
-
-        execute_query("""
-            MATCH (pg:ProductGroup {name: 'automobile'})
-            MATCH (m:Model {name: 'yaris'})
-            MERGE (pg)-[:HAS_MODEL]->(m)
-        """)
-
-        execute_query("""
-            MATCH (m:Model {name: 'yaris'})
-            MATCH (man:Manufacturer {name: 'toyota motor corporation'})
-            MERGE (m)-[:MANUFACTURED_BY]->(man)
-        """)
-
-        execute_query("MERGE (c:Component {name: $name})", {"name": component_name.lower()})
-        execute_query("""
-            MATCH (m:Model {name: 'yaris'})
-            MATCH (c:Component {name: $name})
-            MERGE (m)-[:HAS_COMPONENT]->(c)
-        """, {"name": component_name.lower()})
-
-        # Detect problem block range
-        problems = root.findall("problem")
-        first_problem_index, last_problem_index = None, None
-        for i, elem in enumerate(root):
-            if elem.tag == "problem":
-                first_problem_index = i if first_problem_index is None else first_problem_index
-                last_problem_index = i
-
-        # Ingest nodes before first problem
-        if first_problem_index is not None:
-            for i in range(first_problem_index):
-                element = root[i]
-                label = get_standardized_label(element.tag)
-                text_value = extract_full_text(element)
-                execute_query(f"MERGE (n:{label} {{name: $name}})", {"name": text_value})
-                execute_query(f"""
-                    MATCH (c:Component {{name: $component_name}})
-                    MATCH (n:{label} {{name: $name}})
-                    MERGE (c)-[:HAS_{label}]->(n)
-                """, {"component_name": component_name.lower(), "name": text_value})
+def build_ingestion_plan(elements, component_name: str):
+    """
+    Group top-level elements into the nodes and relationships to write for a component.
+
+    Elements before the first <problem> hang off the component, elements after a <problem>
+    hang off that problem, and elements after the last <problem> additionally hang off the
+    component. Files without any <problem> only contribute the component node itself.
+    Elements following a <problem> without text, or one that failed to parse, have no problem
+    to hang off; they are listed in `dropped_nodes` instead of being written.
+    """
+    component = component_name.lower()
+    leading, trailing, dropped = [], [], []
+    problems, problem_children = [], []
+    current_problem, orphaned = None, False
+
+    for element in elements:
+        if element.tag == "problem":
+            current_problem = (element.text or "").strip().lower() or None
+            orphaned = current_problem is None
+            if current_problem and current_problem not in problems:
+                problems.append(current_problem)
+            trailing = []
+            continue
 
+        node = {"label": get_standardized_label(element.tag), "name": extract_full_text(element)}
+        if orphaned:
+            dropped.append(node)
+        elif current_problem is None:
+            leading.append(node)
+        else:
+            problem_children.append({"problem": current_problem, **node})
+            trailing.append(node)
+
+    return {
+        "component": component,
+        "component_nodes": leading + trailing if problems else [],
         # If too many problems → nest under parent
-        if len(problems) > 3:
-            parent_problem_name = f"{component_name.lower()}_problems"
-            execute_query("MERGE (p:Problem {name: $name})", {"name": parent_problem_name})
-
-        for problem_tag in problems:
-            problem_name = problem_tag.text.strip().lower()
-            execute_query("MERGE (p:Problem {name: $name})", {"name": problem_name})
-
-            if len(problems) > 3:
-                execute_query("""
-                    MATCH (p1:Problem {name: $parent_name})
-                    MATCH (p2:Problem {name: $problem_name})
-                    MERGE (p1)-[:HAS_SUBPROBLEM]->(p2)
-                """, {"parent_name": parent_problem_name, "problem_name": problem_name})
-
-            # Process children of this problem
-            current_index = list(root).index(problem_tag)
-            for i in range(current_index + 1, len(root)):
-                element = root[i]
-                if element.tag == "problem":
+        "parent_problem": f"{component}_problems" if len(problems) > 3 else None,
+        "problems": problems,
+        "problem_children": problem_children,
+        "dropped_nodes": dropped,
+    }
+
+
+def plan_nodes(plan):
+    """Yield (label, name) for every node write in a plan."""
+    yield "Component", plan["component"]
+    for node in plan["component_nodes"]:
+        yield node["label"], node["name"]
+    if plan["parent_problem"]:
+        yield "Problem", plan["parent_problem"]
+    for problem_name in plan["problems"]:
+        yield "Problem", problem_name
+    for child in plan["problem_children"]:
+        yield child["label"], child["name"]
+
+
+def plan_node_count(plan):
+    """Number of node writes a plan performs (used for throughput reporting)."""
+    return sum(1 for _ in plan_nodes(plan))
+
+
+# --------------------------
+# Static base nodes, merged once per process
+# --------------------------
+BASE_NODES_QUERY = """
+    MERGE (pg:ProductGroup {name: 'automobile'})
+    MERGE (man:Manufacturer {name: 'toyota motor corporation'})
+    MERGE (m:Model {name: 'yaris', series: 'ncp91, 93 series'})
+    MERGE (pg)-[:HAS_MODEL]->(m)
+    MERGE (m)-[:MANUFACTURED_BY]->(man)
+"""
+_base_nodes_merged = False
+_base_nodes_lock = threading.Lock()
+
+
+def ensure_base_nodes():
+    global _base_nodes_merged
+    if not _base_nodes_merged:
+        with _base_nodes_lock:
+            if not _base_nodes_merged:
+                with get_driver().session() as session:
+                    session.execute_write(lambda tx: tx.run(BASE_NODES_QUERY).consume())
+                _base_nodes_merged = True
+
+
+# --------------------------
+# Per-node locks for concurrent plan writes
+# --------------------------
+class KeyedLocks:
+    """
+    One lock per key, created on demand. `hold` takes a set of keys in sorted order, so writers
+    that share any key run one after the other and never deadlock, while the rest run in parallel.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    @contextmanager
+    def hold(self, keys):
+        with self._guard:
+            locks = [self._locks.setdefault(key, threading.Lock()) for key in sorted(set(keys))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+
+# Nodes are MERGEd by name without uniqueness constraints, so two transactions merging the same
+# Component, Problem or child node concurrently could both create it. The Problems a component
+# claimed before are locked too: dropping them rewrites their `sources`, which another component
+# sharing them may be rewriting at the same time.
+ingest_locks = KeyedLocks()
+
+
+def plan_lock_keys(plan, claimed_problems=()):
+    return set(plan_nodes(plan)) | {("Problem", name) for name in claimed_problems}
+
+
+def claimed_problems(component):
+    """Names of the Problems whose `sources` currently include the component."""
+    with get_driver().session() as session:
+        return set(session.execute_read(lambda tx: tx.run("""
+            MATCH (p:Problem) WHERE $source IN p.sources
+            RETURN collect(p.name) AS names
+        """, source=component).single()["names"]))
+
+
+# --------------------------
+# Precomputed per-Problem context documents
+# --------------------------
+# Children as "<Label>: <name>" lines grouped by label, read by retrieval instead of a traversal
+CONTEXT_DOC_UPDATE = f"""
+    CALL {{
+        WITH problem
+        OPTIONAL MATCH (problem)-[:{problem_context_rel_types}]->(child)
+        WITH child ORDER BY labels(child)[0], id(child)
+        RETURN [c IN collect(child) | labels(c)[0] + ': ' + c.name] AS doc
+    }}
+    SET problem.context_doc = doc
+"""
+
+
+def refresh_context_docs(batch_size=1000):
+    """Rebuild context_doc on every Problem, e.g. for a graph ingested before the documents existed."""
+    with get_driver().session() as session:
+        summary = session.run("""
+            CALL apoc.periodic.iterate('MATCH (problem:Problem) RETURN problem', $action,
+                                       {batchSize: $batch_size})
+            YIELD total, failedOperations
+            RETURN total, failedOperations
+        """, action=f"WITH problem {CONTEXT_DOC_UPDATE}", batch_size=batch_size).single()
+    print(f"📄 Refreshed context documents for {summary['total']} problem(s), {summary['failedOperations']} failed")
+
+
+# --------------------------
+# Apply a plan with a few UNWIND statements in one transaction
+# --------------------------
+# Every written node carries a hash of its text; embedding_ingestion re-embeds nodes whose
+# content_hash differs from the embedded_hash stored with their vector. Re-ingesting an unchanged
+# node MERGEs it as it is, so its hash (and vector) survive.
+#
+# Problems and the edges below them can be shared by several components, so they record the
+# components that wrote them in `sources`. Edges written before sources existed count as owned by
+# whichever component re-ingests their problem.
+ADD_SOURCE = "apoc.coll.toSet(coalesce({0}.sources, []) + $source)"
+
+# Edges from the component's Problems that the new plan no longer contains; an edge still written
+# by another component only loses this source
+STALE_PROBLEM_EDGES = f"""
+    MATCH (p:Problem)
+    WHERE p.name IN $problems OR $source IN p.sources
+    MATCH (p)-[r:{problem_context_rel_types}]->(n)
+    WHERE ($source IN r.sources OR (r.sources IS NULL AND p.name IN $problems))
+      AND NOT [p.name, type(r), n.name] IN $keep
+    WITH r, n, [s IN coalesce(r.sources, []) WHERE s <> $source] AS remaining
+    FOREACH (_ IN CASE WHEN remaining = [] THEN [1] ELSE [] END | DELETE r)
+    FOREACH (_ IN CASE WHEN remaining = [] THEN [] ELSE [1] END | SET r.sources = remaining)
+    RETURN collect(DISTINCT CASE WHEN remaining = [] THEN id(n) END) AS candidates
+"""
+
+# Nodes left without any relationship after stale edges were removed; Problems still claimed by a
+# component are kept
+DELETE_ORPHANS = """
+    UNWIND $candidates AS node_id
+    MATCH (n) WHERE id(n) = node_id
+    WITH n WHERE NOT (n)--() AND coalesce(n.sources, []) = []
+    WITH n, labels(n)[0] AS label, n.name AS name
+    DELETE n
+    RETURN label, name
+"""
+
+
+def write_ingestion_plan(tx, plan):
+    """
+    Upsert a component's plan and remove what an earlier version of the same file wrote but this
+    one no longer contains: stale edges first, then the nodes they leave orphaned.
+    Returns the (label, name) pairs of the nodes as stored and of the nodes removed.
+    """
+    source = plan["component"]
+    owned_problems = plan["problems"] + ([plan["parent_problem"]] if plan["parent_problem"] else [])
+
+    tx.run("""
+        MATCH (m:Model {name: 'yaris'})
+        MERGE (c:Component {name: $component})
+        SET c.content_hash = apoc.util.sha1([c.name])
+        MERGE (m)-[:HAS_COMPONENT]->(c)
+    """, component=plan["component"])
+    stored = [("Component", plan["component"])] + [("Problem", name) for name in owned_problems]
+
+    candidates = tx.run("""
+        MATCH (c:Component {name: $component})-[r]->(n)
+        WHERE NOT [type(r), n.name] IN $keep
+        DELETE r
+        RETURN collect(DISTINCT id(n)) AS candidates
+    """, component=plan["component"],
+        keep=[["HAS_" + node["label"], node["name"]] for node in plan["component_nodes"]]).single()["candidates"]
+
+    keep = [[child["problem"], "HAS_" + child["label"], child["name"]] for child in plan["problem_children"]]
+    if plan["parent_problem"]:
+        keep += [[plan["parent_problem"], "HAS_SUBPROBLEM", problem_name] for problem_name in plan["problems"]]
+    candidates += tx.run(STALE_PROBLEM_EDGES, source=source, problems=owned_problems,
+                         keep=keep).single()["candidates"]
+
+    # Problems an earlier version of the file wrote that it no longer contains
+    stale = tx.run("""
+        MATCH (p:Problem)
+        WHERE $source IN p.sources AND NOT p.name IN $problems
+        SET p.sources = [s IN p.sources WHERE s <> $source]
+        RETURN collect(id(p)) AS ids, collect(p.name) AS names
+    """, source=source, problems=owned_problems).single()
+    candidates += stale["ids"]
+
+    if plan["component_nodes"]:
+        stored += tx.run("""
+            MATCH (c:Component {name: $component})
+            UNWIND $rows AS row
+            CALL apoc.merge.node([row.label], {name: row.name}) YIELD node
+            SET node.content_hash = apoc.util.sha1([node.name])
+            WITH c, row, node
+            CALL apoc.merge.relationship(c, 'HAS_' + row.label, {}, {}, node, {}) YIELD rel
+            RETURN row.label AS label, node.name AS name
+        """, component=plan["component"], rows=plan["component_nodes"]).values()
+
+    if owned_problems:
+        tx.run(f"""
+            UNWIND $problems AS problem_name
+            MERGE (p:Problem {{name: problem_name}})
+            SET p.content_hash = apoc.util.sha1([p.name]), p.sources = {ADD_SOURCE.format("p")}
+        """, problems=owned_problems, source=source)
+
+    if plan["parent_problem"]:
+        tx.run(f"""
+            MATCH (p1:Problem {{name: $parent_name}})
+            UNWIND $problems AS problem_name
+            MATCH (p2:Problem {{name: problem_name}})
+            MERGE (p1)-[r:HAS_SUBPROBLEM]->(p2)
+            SET r.sources = {ADD_SOURCE.format("r")}
+        """, parent_name=plan["parent_problem"], problems=plan["problems"], source=source)
+
+    if plan["problem_children"]:
+        stored += tx.run(f"""
+            UNWIND $rows AS row
+            MATCH (p:Problem {{name: row.problem}})
+            CALL apoc.merge.node([row.label], {{name: row.name}}) YIELD node
+            SET node.content_hash = apoc.util.sha1([node.name])
+            WITH p, row, node
+            CALL apoc.merge.relationship(p, 'HAS_' + row.label, {{}}, {{}}, node, {{}}) YIELD rel
+            SET rel.sources = {ADD_SOURCE.format("rel")}
+            RETURN row.label AS label, node.name AS name
+        """, rows=plan["problem_children"], source=source).values()
+
+    removed = [(record["label"], record["name"])
+               for record in tx.run(DELETE_ORPHANS, candidates=list(set(candidates)))]
+
+    # The component's problems and the ones it dropped; names are never rewritten, so no other
+    # Problem's document changes
+    touched = owned_problems + stale["names"]
+    if touched:
+        tx.run(f"""
+            UNWIND $problems AS problem_name
+            MATCH (problem:Problem {{name: problem_name}})
+            WITH DISTINCT problem
+            {CONTEXT_DOC_UPDATE}
+        """, problems=touched)
+    return list(dict.fromkeys(map(tuple, stored))), removed
+
+
+def apply_ingestion_plan(plan):
+    ensure_base_nodes()
+    with get_driver().session() as session:
+        return session.execute_write(write_ingestion_plan, plan)
+
+
+# --------------------------
+# Previous write path: one session per MERGE (kept for benchmarking)
+# --------------------------
+def apply_ingestion_plan_per_query(plan):
+    execute_query(BASE_NODES_QUERY)
+    component = plan["component"]
+    execute_query("MERGE (c:Component {name: $name})", {"name": component})
+    execute_query("""
+        MATCH (m:Model {name: 'yaris'})
+        MATCH (c:Component {name: $name})
+        MERGE (m)-[:HAS_COMPONENT]->(c)
+    """, {"name": component})
+
+    for node in plan["component_nodes"]:
+        label = node["label"]
+        execute_query(f"MERGE (n:{label} {{name: $name}})", {"name": node["name"]})
+        execute_query(f"""
+            MATCH (c:Component {{name: $component_name}})
+            MATCH (n:{label} {{name: $name}})
+            MERGE (c)-[:HAS_{label}]->(n)
+        """, {"component_name": component, "name": node["name"]})
+
+    if plan["parent_problem"]:
+        execute_query("MERGE (p:Problem {name: $name})", {"name": plan["parent_problem"]})
+    for problem_name in plan["problems"]:
+        execute_query("MERGE (p:Problem {name: $name})", {"name": problem_name})
+        if plan["parent_problem"]:
+            execute_query("""
+                MATCH (p1:Problem {name: $parent_name})
+                MATCH (p2:Problem {name: $problem_name})
+                MERGE (p1)-[:HAS_SUBPROBLEM]->(p2)
+            """, {"parent_name": plan["parent_problem"], "problem_name": problem_name})
+
+    for child in plan["problem_children"]:
+        label = child["label"]
+        execute_query(f"""
+            MATCH (p:Problem {{name: $problem_name}})
+            OPTIONAL MATCH (p)-[:HAS_{label}]->(n:{label} {{name: $name}})
+            WITH p, n, $name AS name, "{label}" AS label
+            CALL apoc.do.when(
+                n IS NULL,
+                'CALL apoc.merge.node([label], {{name: name}}, {{}}) YIELD node
+                 MERGE (p)-[:HAS_' + label + ']->(node)
+                 RETURN node',
+                'SET n.name = n.name + " | " + name RETURN n',
+                {{p: p, name: name, label: label}}
+            ) YIELD value
+            RETURN value
+        """, {"problem_name": child["problem"], "name": child["name"]})
+
+
+# --------------------------
+# Main function to parse and insert XML into Neo4j
+# --------------------------
+def parse_component(xml_content, component_name: str):
+    """Build the plan for one component from its XML string or open file."""
+    skipped = []
+    plan = build_ingestion_plan(component_elements(xml_content, skipped), component_name)
+    plan["skipped_fragments"] = skipped
+    return plan
+
+
+def insert_plan(plan, log=print, update_sparse_index=True):
+    """
+    Write a parsed plan; returns it with the nodes as stored and removed, or None on failure.
+    Batch runners pass update_sparse_index=False and apply those to the sparse index once per run.
+    """
+    component_name = plan["component"]
+    try:
+        claimed = claimed_problems(component_name)
+        while True:
+            with ingest_locks.hold(plan_lock_keys(plan, claimed)):
+                # A writer of the same component may have claimed more before the locks were taken
+                current = claimed_problems(component_name)
+                if current <= claimed:
+                    stored, removed = apply_ingestion_plan(plan)
                     break
-                label = get_standardized_label(element.tag)
-                text_value = extract_full_text(element)
-                execute_query(f"""
-                    MATCH (p:Problem {{name: $problem_name}})
-                    OPTIONAL MATCH (p)-[:HAS_{label}]->(n:{label} {{name: $name}})
-                    WITH p, n, $name AS name, "{label}" AS label
-                    CALL apoc.do.when(
-                        n IS NULL,
-                        'CALL apoc.merge.node([label], {{name: name}}, {{}}) YIELD node
-                         MERGE (p)-[:HAS_' + label + ']->(node)
-                         RETURN node',
-                        'SET n.name = n.name + " | " + name RETURN n',
-                        {{p: p, name: name, label: label}}
-                    ) YIELD value
-                    RETURN value
-                """, {"problem_name": problem_name, "name": text_value})
-
-        # Ingest after last problem
-        if last_problem_index is not None:
-            for i in range(last_problem_index + 1, len(root)):
-                element = root[i]
-                label = get_standardized_label(element.tag)
-                text_value = extract_full_text(element)
-                execute_query(f"MERGE (n:{label} {{name: $name}})", {"name": text_value})
-                execute_query(f"""
-                    MATCH (c:Component {{name: $component_name}})
-                    MATCH (n:{label} {{name: $name}})
-                    MERGE (c)-[:HAS_{label}]->(n)
-                """, {"component_name": component_name.lower(), "name": text_value})
-
-        print(f"✅ Completed ingestion for component: {component_name}")
+            claimed |= current
+        bump_graph_version()
+        if update_sparse_index:
+            sparse_index_store.update(added=stored, removed=removed)
+
+        plan["stored_nodes"], plan["removed_nodes"] = stored, removed
+        if removed:
+            log(f"🧹 Removed {len(removed)} node(s) no longer in `{component_name}`")
+        for fragment in plan["skipped_fragments"]:
+            log(f"⚠️ Skipped malformed fragment in `{component_name}` at line {fragment['line']}: {fragment['error']}")
+        for node in plan["dropped_nodes"]:
+            log(f"⚠️ Dropped {node['label']} without a problem in `{component_name}`: {node['name'][:60]!r}")
+        log(f"✅ Completed ingestion for component: {component_name}")
+        return plan
 
     except Exception as e:
-        print(f"❌ Error ingesting component `{component_name}`: {e}")
+        log(f"❌ Error ingesting component `{component_name}`: {e}")
+
+
+def parse_and_insert_data(xml_content, component_name: str, log=print, update_sparse_index=True):
+    """Ingest one component from its XML string or open file; returns the plan, or None on failure."""
+    try:
+        plan = parse_component(xml_content, component_name)
+    except Exception as e:
+        log(f"❌ Error ingesting component `{component_name}`: {e}")
+        return None
+    return insert_plan(plan, log, update_sparse_index)
 
 
 # --------------------------
-# Example batch runner
+# Change manifest: content hash per source file
+# --------------------------
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_manifest(manifest_path, manifest):
+    directory = os.path.dirname(manifest_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def file_content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def component_name_for(file_name):
+    return file_name.replace("_extracted.tsx", "").replace(".tsx", "").lower()
+
+
+def manifest_key(path, root):
+    """Manifest entries are keyed by the path relative to the ingest root, so equal file names in
+    different directories never share an entry."""
+    return os.path.relpath(path, root).replace(os.sep, "/")
+
+
+def duplicate_components(paths, manifest, root):
+    """
+    Map each file whose component name is already claimed by another file to that file's manifest key.
+    A Component node, and the `sources` claims below it, are keyed by the component name alone, so two
+    such files would overwrite and delete each other's data. The first file in `paths` wins, unless the
+    manifest records the name for another file that still exists under `root`.
+    """
+    owners = {}
+    for key, entry in manifest.items():
+        if "component" in entry and os.path.isfile(os.path.join(root, key)):
+            owners.setdefault(entry["component"], key)
+    duplicates = {}
+    for path in paths:
+        key = manifest_key(path, root)
+        owner = owners.setdefault(component_name_for(os.path.basename(path)), key)
+        if owner != key:
+            duplicates[path] = owner
+    return duplicates
+
+
+def resolve_inputs(inputs):
+    """Expand directories (their files) and glob patterns into a sorted, de-duplicated list of files."""
+    paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths.update(os.path.join(pattern, name) for name in os.listdir(pattern))
+        else:
+            paths.update(glob.glob(pattern, recursive=True))
+    return sorted(path for path in paths if os.path.isfile(path))
+
+
+def parse_file(path):
+    """Plan one component file; runs in the parse processes of ingest_files."""
+    with open(path, "r", encoding="utf-8") as file:
+        return parse_component(file, component_name_for(os.path.basename(path)))
+
+
+def ingest_files(paths, manifest_path=INGEST_MANIFEST_PATH, force=False, workers=INGEST_WORKERS,
+                 retry_path=INGEST_RETRY_PATH, root=None, parse_workers=INGEST_PARSE_WORKERS):
+    """
+    Ingest the files whose content hash differs from the manifest.
+
+    Files are parsed into plans by `parse_workers` processes, since parsing is CPU-bound and a
+    thread pool would run it under the GIL, and the plans are written by `workers` threads, which
+    mostly wait on Neo4j. At most twice as many files as there are writers are parsed or being
+    written at a time, so fast parsing never piles up plans in memory.
+
+    Manifest entries are keyed by the path relative to `root` (default: the working directory).
+    Files whose component name another file already uses are refused (see duplicate_components). Each file is recorded as soon as it is written, so an interrupted run keeps its progress; the
+    sparse index is updated once at the end, also when the run is interrupted. Failed files are
+    listed in `retry_path` (removed when nothing failed) for a rerun with --retry.
+    """
+    root = root or os.getcwd()
+    workers = max(1, workers)
+    manifest = load_manifest(manifest_path)
+    duplicates = duplicate_components(paths, manifest, root)
+    for path, owner in duplicates.items():
+        print(f"❌ Refused `{path}`: component `{component_name_for(os.path.basename(path))}` "
+              f"is already ingested from `{owner}`")
+    pending, unchanged = {}, 0
+    for path in paths:
+        if path in duplicates:
+            continue
+        content_hash = file_content_hash(path)
+        if not force and manifest.get(manifest_key(path, root), {}).get("sha256") == content_hash:
+            unchanged += 1
+        else:
+            pending[path] = content_hash
+
+    ingested, failed = 0, []
+    # (label, name) -> whether the node exists after the latest write that touched it
+    sparse_updates = {}
+    if pending:
+        ensure_base_nodes()
+        queue = iter(pending)
+        in_flight = {}
+        # Spawned rather than forked: this process already runs driver and tqdm threads
+        with ProcessPoolExecutor(max_workers=max(1, parse_workers),
+                                 mp_context=multiprocessing.get_context("spawn")) as parsers, \
+                ThreadPoolExecutor(max_workers=workers) as writers, \
+                tqdm(total=len(pending), desc="Ingesting", unit="file") as progress:
+
+            def parse_next():
+                path = next(queue, None)
+                if path is not None:
+                    in_flight[parsers.submit(parse_file, path)] = (path, False)
+
+            for _ in range(2 * workers):
+                parse_next()
+            try:
+                while in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        path, written = in_flight.pop(future)
+                        if written:
+                            # insert_plan logs its own failures and returns None
+                            plan = future.result()
+                        else:
+                            try:
+                                plan = future.result()
+                            except Exception as e:
+                                tqdm.write(f"❌ Error parsing `{path}`: {e}")
+                                plan = None
+                            if plan is not None:
+                                in_flight[writers.submit(insert_plan, plan, tqdm.write, False)] = (path, True)
+                                continue
+
+                        progress.update()
+                        parse_next()
+                        if plan is None:
+                            failed.append(path)
+                            continue
+                        sparse_updates.update(dict.fromkeys(plan["removed_nodes"], False))
+                        sparse_updates.update(dict.fromkeys(plan["stored_nodes"], True))
+                        manifest[manifest_key(path, root)] = {
+                            "sha256": pending[path], "component": plan["component"], "nodes": plan_node_count(plan),
+                            "skipped_fragments": len(plan["skipped_fragments"]),
+                            "dropped_nodes": len(plan["dropped_nodes"]), "removed_nodes": len(plan["removed_nodes"]),
+                            "ingested_at": int(time.time())}
+                        save_manifest(manifest_path, manifest)
+                        ingested += 1
+            finally:
+                sparse_index_store.update(added=[node for node, exists in sparse_updates.items() if exists],
+                                          removed=[node for node, exists in sparse_updates.items() if not exists])
+
+    if failed:
+        directory = os.path.dirname(retry_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(retry_path, "w", encoding="utf-8") as file:
+            file.writelines(f"{path}\n" for path in sorted(failed))
+        print(f"⚠️ Failed files written to {retry_path}")
+    elif os.path.exists(retry_path):
+        os.remove(retry_path)
+
+    print(f"📦 {ingested} file(s) ingested, {unchanged} unchanged, {len(failed)} failed, "
+          f"{len(duplicates)} refused as duplicate components")
+    return ingested, unchanged, len(failed) + len(duplicates)
+
+
+def ingest_folder(folder_path, manifest_path=INGEST_MANIFEST_PATH, force=False, workers=INGEST_WORKERS):
+    return ingest_files(resolve_inputs([folder_path]), manifest_path, force, workers, root=folder_path)
+
+
+# --------------------------
+# Batch runner
 # --------------------------
 if __name__ == "__main__":
-    folder_path = r"C:\Users\dines\Downloads\Toyota Yaris 2005 Repair Manual extracted new\Toyota Yaris 2005 Repair Manual extracted"
-    if os.path.exists(folder_path):
-        for file_name in os.listdir(folder_path):
-            with open(os.path.join(folder_path, file_name), "r", encoding="utf-8") as file:
-                content = file.read()
-                component_name = file_name.replace("_extracted.tsx", "").replace(".tsx", "").lower()
-                parse_and_insert_data(content, component_name)
-    driver.close()
+    parser = argparse.ArgumentParser(description="Ingest extracted component files into Neo4j.")
+    parser.add_argument("inputs", nargs="*", help="Folders, files or glob patterns of extracted component files")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS,
+                        help="Concurrent component writers (default: INGEST_WORKERS)")
+    parser.add_argument("--parse-workers", type=int, default=INGEST_PARSE_WORKERS,
+                        help="Processes parsing files into plans (default: INGEST_PARSE_WORKERS)")
+    parser.add_argument("--root", default=os.getcwd(),
+                        help="Directory the manifest keys are relative to (default: the working directory)")
+    parser.add_argument("--manifest", default=INGEST_MANIFEST_PATH)
+    parser.add_argument("--force", action="store_true", help="Re-ingest files even if their hash is unchanged.")
+    parser.add_argument("--retry-file", default=INGEST_RETRY_PATH)
+    parser.add_argument("--retry", action="store_true", help="Also ingest the files listed in the retry file.")
+    parser.add_argument("--refresh-context-docs", action="store_true",
+                        help="Rebuild the context document of every Problem after ingesting.")
+    args = parser.parse_args()
+
+    inputs = list(args.inputs)
+    if args.retry and os.path.exists(args.retry_file):
+        with open(args.retry_file, "r", encoding="utf-8") as file:
+            inputs.extend(line.strip() for line in file if line.strip())
+    if not inputs and not args.refresh_context_docs:
+        parser.error("no input files (pass folders, files or globs, or --retry)")
+
+    if inputs:
+        ingest_files(resolve_inputs(inputs), args.manifest, args.force, args.workers, args.retry_file,
+                     root=args.root, parse_workers=args.parse_workers)
+    if args.refresh_context_docs:
+        refresh_context_docs()
+    close_clients()
@@ -1,25 +1,41 @@
 import os
 import json
-from dotenv import load_dotenv
-from neo4j import GraphDatabase
-import openai
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from data.clients import get_driver, get_openai_client, close_clients
 
 # -------------------------
-# Load secrets and configs
+# Load configs
 # -------------------------
-load_dotenv()
-uri = os.getenv("NEO4J_URI")
-username = os.getenv("NEO4J_USERNAME")
-password = os.getenv("NEO4J_PASSWORD")
-openai.api_key = os.getenv("OPENAI_API_KEY")
-EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+EMBEDDING_MAX_IN_FLIGHT = int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", "4"))
+EMBEDDING_CHECKPOINT_PATH = os.getenv("EMBEDDING_CHECKPOINT_PATH", "embedding_checkpoint.json")
 
-from constants import schema_description, vector_index_names, default_prompt
+from data.constants import schema_description, default_prompt
+from data.graph_version import bump_graph_version
+from data.embedding_profile import (LEGACY_PROFILE, embedding_dimensions, embedding_request, profile_name,
+                                    profile_suffix, vector_property, embedded_hash_property, vector_index_name)
 
-# -------------------------
-# Initialize Neo4j driver
-# -------------------------
-driver = GraphDatabase.driver(uri, auth=(username, password))
+EMBEDDING_PROFILE = profile_name()
+VECTOR_PROPERTY = vector_property()
+EMBEDDED_HASH_PROPERTY = embedded_hash_property()
+# Only the unsuffixed legacy slot can hold another profile's vectors (profiles used to be switched in
+# place), so only it records the profile in `embedding_profile`; unmarked vectors are the legacy profile's
+MARKS_PROFILE = profile_suffix() == ""
+PROFILE_MISMATCH = (f"\n    OR coalesce(n.embedding_profile, '{LEGACY_PROFILE}') <> '{EMBEDDING_PROFILE}'"
+                    if MARKS_PROFILE else "")
+
+# Nodes without a vector, whose text changed (content_hash set by ingestion) since they were embedded,
+# or whose legacy slot holds another profile
+NEEDS_EMBEDDING = f"""(n.{VECTOR_PROPERTY} IS NULL
+    OR (n.content_hash IS NOT NULL AND coalesce(n.{EMBEDDED_HASH_PROPERTY}, '') <> n.content_hash){PROFILE_MISMATCH})"""
+
+
+def set_vector(vector, content_hash):
+    """SET items storing a vector, and the hash of the text it was computed from, in the profile's slot."""
+    items = f"n.{VECTOR_PROPERTY} = {vector}, n.{EMBEDDED_HASH_PROPERTY} = {content_hash}"
+    return items + ", n.embedding_profile = $profile" if MARKS_PROFILE else items
 
 
 # -------------------------
@@ -29,7 +45,7 @@ def get_openai_embedding(text):
     try:
         if not text:
             return None
-        response = openai.embeddings.create(input=text, model=EMBEDDING_MODEL)
+        response = get_openai_client().embeddings.create(input=text, **embedding_request())
         return response.data[0].embedding
     except Exception as e:
         print(f"❌ Error generating embedding: {e}")
@@ -40,15 +56,17 @@ def get_openai_embedding(text):
 # Store embeddings into Neo4j
 # -------------------------
 def store_embeddings():
+    stored = 0
     try:
-        with driver.session() as session:
+        with get_driver().session() as session:
             for node_type, attributes in schema_description.items():
                 print(f"📌 Processing {node_type}...")
 
                 query = f"""
                 MATCH (n:{node_type})
-                WHERE any(attr IN {attributes} WHERE n[attr] IS NOT NULL) AND n.vector IS NULL
-                RETURN id(n) AS node_id, {', '.join([f"n.{attr} AS {attr}" for attr in attributes])}
+                WHERE any(attr IN {attributes} WHERE n[attr] IS NOT NULL) AND {NEEDS_EMBEDDING}
+                RETURN id(n) AS node_id, n.content_hash AS content_hash,
+                       {', '.join([f"n.{attr} AS {attr}" for attr in attributes])}
                 """
 
                 result = session.run(query)
@@ -57,18 +75,256 @@ def store_embeddings():
                     text_to_embed = " ".join([str(record[attr]) for attr in attributes if record[attr]])
                     vector = get_openai_embedding(text_to_embed)
                     if vector:
-                        session.run("""
+                        session.run(f"""
                             MATCH (n) WHERE id(n) = $node_id
-                            SET n.vector = $vector
-                        """, node_id=node_id, vector=vector)
+                            SET {set_vector("$vector", "$content_hash")}
+                        """, node_id=node_id, vector=vector, content_hash=record["content_hash"],
+                                    profile=EMBEDDING_PROFILE)
+                        stored += 1
         print("✅ Embeddings stored successfully in Neo4j!")
     except Exception as e:
         print(f"❌ Error storing embeddings: {e}")
+    finally:
+        # New vectors change retrieval results, so answers cached against the old graph are stale
+        if stored:
+            bump_graph_version()
+
+
+# -------------------------
+# Batched backfill helpers
+# -------------------------
+def get_openai_embeddings(texts):
+    """Embed many texts in a single request, returned in input order."""
+    response = get_openai_client().embeddings.create(input=texts, **embedding_request())
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def load_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return {}
+    with open(checkpoint_path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    # Write to a temp file first so an interrupted save never corrupts the checkpoint
+    tmp_path = f"{checkpoint_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(checkpoint, file)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def fetch_pending_nodes(node_type, attributes, after_id, limit):
+    """Read the next page of un-embedded or stale nodes, keyed on id(n) so pages never overlap."""
+    query = f"""
+    MATCH (n:{node_type})
+    WHERE id(n) > $after_id
+      AND any(attr IN {attributes} WHERE n[attr] IS NOT NULL) AND {NEEDS_EMBEDDING}
+    RETURN id(n) AS node_id, n.content_hash AS content_hash,
+           {', '.join([f"n.{attr} AS {attr}" for attr in attributes])}
+    ORDER BY node_id
+    LIMIT $limit
+    """
+    with get_driver().session() as session:
+        return list(session.run(query, after_id=after_id, limit=limit))
+
+
+def write_vectors(tx, rows):
+    tx.run(f"""
+        UNWIND $rows AS row
+        MATCH (n) WHERE id(n) = row.node_id
+        SET {set_vector("row.vector", "row.content_hash")}
+    """, rows=rows, profile=EMBEDDING_PROFILE)
+
+
+def embed_and_write_batch(records, attributes):
+    """Embed one page of nodes with a single API call and write the vectors back in one transaction."""
+    rows = []
+    for record in records:
+        text_to_embed = " ".join([str(record[attr]) for attr in attributes if record[attr]])
+        if text_to_embed:
+            rows.append({"node_id": record["node_id"], "content_hash": record["content_hash"], "text": text_to_embed})
+    if not rows:
+        return 0
+
+    vectors = get_openai_embeddings([row["text"] for row in rows])
+    # The hash read with the text: if the node changes again mid-run it stays stale for the next run
+    payload = [{"node_id": row["node_id"], "content_hash": row["content_hash"], "vector": vector}
+               for row, vector in zip(rows, vectors)]
+    with get_driver().session() as session:
+        session.execute_write(write_vectors, payload)
+    return len(payload)
+
+
+# -------------------------
+# Batched, resumable backfill
+# -------------------------
+def store_embeddings_batched(batch_size=EMBEDDING_BATCH_SIZE, max_in_flight=EMBEDDING_MAX_IN_FLIGHT,
+                             checkpoint_path=EMBEDDING_CHECKPOINT_PATH):
+    """
+    Backfill missing vectors with batched embedding requests and UNWIND writes.
+
+    Up to `max_in_flight` batches run concurrently. The checkpoint stores, per label, the highest
+    node id below which every batch has been written, so an interrupted run resumes from there.
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint.get("profile", EMBEDDING_PROFILE) != EMBEDDING_PROFILE:
+        # Positions reached under another profile say nothing about which nodes match this one
+        checkpoint = {}
+    checkpoint["profile"] = EMBEDDING_PROFILE
+    failed_batches = 0
+    total_stored = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for node_type, attributes in schema_description.items():
+                after_id = checkpoint.get(node_type, -1)
+                print(f"📌 Processing {node_type} (resuming after id {after_id})...")
+
+                # Batches in submission order; the checkpoint only moves past a fully written prefix
+                pending = []
+                label_failed = False
+                stored = 0
+                exhausted = False
+
+                while pending or not exhausted:
+                    while not exhausted and len(pending) < max_in_flight:
+                        records = fetch_pending_nodes(node_type, attributes, after_id, batch_size)
+                        if not records:
+                            exhausted = True
+                            break
+                        after_id = records[-1]["node_id"]
+                        future = executor.submit(embed_and_write_batch, records, attributes)
+                        pending.append((future, after_id))
+
+                    if not pending:
+                        break
+                    wait([future for future, _ in pending], return_when=FIRST_COMPLETED)
+
+                    while pending and pending[0][0].done():
+                        future, last_id = pending.pop(0)
+                        try:
+                            stored += future.result()
+                        except Exception as e:
+                            failed_batches += 1
+                            label_failed = True
+                            print(f"❌ Batch ending at id {last_id} failed for {node_type}: {e}")
+                        if not label_failed:
+                            checkpoint[node_type] = last_id
+                            save_checkpoint(checkpoint_path, checkpoint)
+
+                total_stored += stored
+                print(f"✅ {node_type}: stored {stored} vectors")
+
+        if failed_batches:
+            print(f"⚠️ {failed_batches} batch(es) failed; re-run to resume from {checkpoint_path}")
+        else:
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+            print("✅ Embeddings stored successfully in Neo4j!")
+    except Exception as e:
+        print(f"❌ Error storing embeddings: {e}")
+    finally:
+        if total_stored:
+            bump_graph_version()
+
+
+# -------------------------
+# Vector indexes per embedding profile (blue/green)
+# -------------------------
+def create_vector_indexes(dimensions=None, labels=None):
+    """
+    Create each label's vector index over the profile's own property, next to the indexes of the
+    profile retrieval currently serves, which keep answering queries during the backfill.
+
+    Only the legacy profile shares its names with vectors written by older in-place switches: an
+    unsuffixed index of another size has to be dropped and recreated, and vector search on that label
+    returns nothing until it is rebuilt.
+    """
+    dimensions = dimensions or embedding_dimensions()
+    with get_driver().session() as session:
+        for label in labels or schema_description:
+            index_name = vector_index_name(label)
+            existing = session.run("SHOW VECTOR INDEXES YIELD name, options WHERE name = $name RETURN options",
+                                   name=index_name).single()
+            if existing and existing["options"]["indexConfig"].get("vector.dimensions") == dimensions:
+                print(f"✅ {index_name} already has {dimensions} dimensions")
+                continue
+            if existing:
+                print(f"⚠️ Dropping {index_name}: vector search on {label} is unavailable until it is rebuilt")
+                session.run(f"DROP INDEX {index_name} IF EXISTS")
+            session.run(f"""
+                CREATE VECTOR INDEX {index_name} FOR (n:{label}) ON (n.{VECTOR_PROPERTY})
+                OPTIONS {{ indexConfig: {{ `vector.dimensions`: {int(dimensions)}, `vector.similarity_function`: 'cosine' }} }}
+            """)
+            print(f"🔁 Created {index_name} on {VECTOR_PROPERTY} with {dimensions} dimensions")
+
+
+def drop_other_vector_profiles(labels=None, batch_size=10000):
+    """
+    Drop the vector indexes of every profile but the configured one and remove their vectors from the
+    nodes. Run it only once retrieval has been switched to the configured profile.
+    """
+    labels = set(labels or schema_description)
+    keep = {vector_index_name(label) for label in labels}
+    with get_driver().session() as session:
+        indexes = list(session.run("""
+            SHOW VECTOR INDEXES YIELD name, labelsOrTypes, properties
+            WHERE name STARTS WITH 'vectorIndex_'
+            RETURN name, labelsOrTypes[0] AS label, properties[0] AS property
+        """))
+        for index in indexes:
+            if index["name"] in keep or index["label"] not in labels:
+                continue
+            session.run(f"DROP INDEX {index['name']} IF EXISTS")
+            print(f"🗑️ Dropped {index['name']}")
+            if index["property"] == VECTOR_PROPERTY:
+                continue
+            # The hash property shares the vector property's profile suffix
+            removed = [index["property"], "embedded_hash" + index["property"][len("vector"):]]
+            if index["property"] == "vector":
+                removed.append("embedding_profile")
+            summary = session.run("""
+                CALL apoc.periodic.iterate($match, $action, {batchSize: $batch_size})
+                YIELD total, failedOperations
+                RETURN total, failedOperations
+            """, match=f"MATCH (n:`{index['label']}`) WHERE n.`{index['property']}` IS NOT NULL RETURN n",
+                action="REMOVE " + ", ".join(f"n.`{name}`" for name in removed),
+                batch_size=batch_size).single()
+            print(f"🧹 Removed {index['property']} from {summary['total']} {index['label']} node(s), "
+                  f"{summary['failedOperations']} failed")
 
 
 # -------------------------
 # Run the embedding job
 # -------------------------
 if __name__ == "__main__":
-    store_embeddings()
-    driver.close()
+    parser = argparse.ArgumentParser(description="Store node embeddings in Neo4j.")
+    parser.add_argument("--batched", action="store_true",
+                        help="Use the batched, resumable backfill instead of one request per node.")
+    parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--max-in-flight", type=int, default=EMBEDDING_MAX_IN_FLIGHT)
+    parser.add_argument("--checkpoint", default=EMBEDDING_CHECKPOINT_PATH)
+    parser.add_argument("--reset", action="store_true", help="Discard any existing checkpoint first.")
+    parser.add_argument("--create-indexes", "--rebuild-indexes", action="store_true",
+                        help="Create the configured profile's vector indexes first, next to the ones retrieval "
+                             "serves; the backfill then fills the profile's own vector property. Only the "
+                             "legacy text-embedding-3-small indexes are dropped and recreated in place, with "
+                             "vector search down on them until they are rebuilt.")
+    parser.add_argument("--drop-other-profiles", action="store_true",
+                        help="After retrieval has switched to the configured profile, drop the vector indexes "
+                             "and vectors of every other profile.")
+    args = parser.parse_args()
+
+    print(f"📐 Embedding profile {EMBEDDING_PROFILE} ({embedding_dimensions()} dimensions)")
+    if args.create_indexes:
+        create_vector_indexes()
+
+    if args.drop_other_profiles:
+        drop_other_vector_profiles()
+    elif args.batched:
+        if args.reset and os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
+        store_embeddings_batched(args.batch_size, args.max_in_flight, args.checkpoint)
+    else:
+        store_embeddings()
+    close_clients()
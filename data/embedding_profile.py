@@ -0,0 +1,72 @@
+import os
+import re
+from dotenv import load_dotenv
+
+# -------------------------
+# Embedding profile shared by ingestion, index management and retrieval
+# -------------------------
+load_dotenv()
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+# Empty means the model's native size; text-embedding-3 models accept a shorter `dimensions`
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS") or 0) or None
+VECTOR_SNAPSHOT_DTYPE = os.getenv("VECTOR_SNAPSHOT_DTYPE", "float32")
+
+MODEL_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+# Graphs embedded before profiles had their own slots hold this profile in `vector` / `vectorIndex_<Label>`
+LEGACY_PROFILE = "text-embedding-3-small"
+
+
+def supports_dimensions(model=EMBEDDING_MODEL):
+    return model.startswith("text-embedding-3")
+
+
+def embedding_dimensions(model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS):
+    """Length of the vectors the profile produces, i.e. the size the vector indexes must be created with."""
+    if dimensions and supports_dimensions(model):
+        return dimensions
+    return MODEL_DIMENSIONS.get(model, 1536)
+
+
+def embedding_request(model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS):
+    """Keyword arguments for embeddings.create; `dimensions` is only sent when it shortens the vector."""
+    request = {"model": model}
+    if dimensions and supports_dimensions(model) and dimensions != MODEL_DIMENSIONS.get(model):
+        request["dimensions"] = dimensions
+    return request
+
+
+def profile_name(model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS):
+    """
+    Names the property and indexes a profile's vectors live in, the query-cache key and the profile of
+    local snapshots, so vectors from different profiles are never compared. The model's native size is
+    named by the model alone; nodes embedded before profiles existed are assumed to carry LEGACY_PROFILE.
+    """
+    request = embedding_request(model, dimensions)
+    return f"{model}@{request['dimensions']}" if "dimensions" in request else model
+
+
+def profile_suffix(profile=None):
+    """
+    Each profile stores its vectors in its own node property and vector indexes, so a new profile can
+    be backfilled and indexed while retrieval still serves the current one. The legacy profile keeps
+    the unsuffixed names.
+    """
+    profile = profile or profile_name()
+    return "" if profile == LEGACY_PROFILE else "_" + re.sub(r"\W", "_", profile)
+
+
+def vector_property(profile=None):
+    return "vector" + profile_suffix(profile)
+
+
+def embedded_hash_property(profile=None):
+    return "embedded_hash" + profile_suffix(profile)
+
+
+def vector_index_name(label, profile=None):
+    return f"vectorIndex_{label}" + profile_suffix(profile)
@@ -0,0 +1,28 @@
+import os
+import time
+import threading
+
+# -------------------------
+# Graph version marker shared by ingestion and retrieval
+# -------------------------
+GRAPH_VERSION_PATH = os.getenv("GRAPH_VERSION_PATH", ".cache/graph_version")
+
+
+def bump_graph_version(path=GRAPH_VERSION_PATH):
+    """Record that the graph changed; caches built on the previous version become invalid."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Per-writer temp file: concurrent ingestion workers bump the version at the same time
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(str(time.time_ns()))
+    os.replace(tmp_path, path)
+
+
+def read_graph_version(path=GRAPH_VERSION_PATH):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return ""
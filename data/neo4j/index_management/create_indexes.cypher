@@ -1,4 +1,6 @@
 // === VECTOR INDEXES ===
+// 1536 dimensions match the default embedding profile (text-embedding-3-small). Other profiles get their own
+// property and indexes via: python -m data.data_ingestion.embedding_ingestion --batched --create-indexes
 CREATE VECTOR INDEX vectorIndex_ProductGroup FOR (n:ProductGroup) ON (n.vector)
 OPTIONS { indexConfig: { `vector.dimensions`: 1536, `vector.similarity_function`: 'cosine' } };
 
@@ -36,6 +38,12 @@ CREATE VECTOR INDEX vectorIndex_TestProcedures FOR (n:TestProcedures) ON (n.vect
 OPTIONS { indexConfig: { `vector.dimensions`: 1536, `vector.similarity_function`: 'cosine' } };
 
 
+// === LOOKUP INDEXES ===
+// Problem and Component names are MERGE keys and context-document lookups
+CREATE INDEX problem_name IF NOT EXISTS FOR (n:Problem) ON (n.name);
+CREATE INDEX component_name IF NOT EXISTS FOR (n:Component) ON (n.name);
+
+
 // === FULLTEXT INDEXES ===
 CREATE FULLTEXT INDEX search_ProductGroup FOR (n:ProductGroup) ON EACH [n.name];
 CREATE FULLTEXT INDEX search_Manufacturer FOR (n:Manufacturer) ON EACH [n.name];
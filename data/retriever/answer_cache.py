@@ -0,0 +1,87 @@
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    Final answers keyed by query embedding.
+
+    A lookup hits when a live entry's cosine similarity to the query is at least `threshold`.
+    Entries expire after `ttl_seconds`, the least recently used entry is dropped beyond
+    `capacity`, and the whole cache is cleared whenever `version_source()` (the graph
+    version written by ingestion and store_embeddings) changes.
+    """
+
+    def __init__(self, threshold=0.95, capacity=1000, ttl_seconds=3600, version_source=None):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self.version_source = version_source
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._keys = []
+        self._next_key = 0
+        self._version = version_source() if version_source else None
+        self._lock = threading.Lock()
+
+    def _check_version(self):
+        if self.version_source is None:
+            return
+        version = self.version_source()
+        if version != self._version:
+            self._entries.clear()
+            self._matrix = None
+            self._version = version
+
+    def _expire(self, now):
+        expired = [key for key, entry in self._entries.items() if now - entry["created_at"] > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def lookup(self, query_vector):
+        if query_vector is None:
+            return None
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        with self._lock:
+            self._check_version()
+            self._expire(time.time())
+            if self._entries:
+                if self._matrix is None:
+                    self._keys = list(self._entries)
+                    self._matrix = np.stack([self._entries[key]["vector"] for key in self._keys])
+                scores = self._matrix @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    key = self._keys[best]
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key]["answer"]
+            self.misses += 1
+            return None
+
+    def store(self, query_vector, answer):
+        if query_vector is None or not answer:
+            return
+        vector = np.asarray(query_vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        with self._lock:
+            self._check_version()
+            self._entries[self._next_key] = {"vector": vector, "answer": answer, "created_at": time.time()}
+            self._next_key += 1
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"lookups": lookups, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                    "entries": len(self._entries)}
@@ -0,0 +1,88 @@
+import re
+import threading
+
+from data.retriever.conversation_memory import estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_counters = {}
+_loading = set()
+_lock = threading.Lock()
+
+
+def load_token_counter(model):
+    """
+    Load the tiktoken counter for `model`, falling back to the estimate when the encoding cannot be
+    loaded. On a cold tiktoken cache this downloads the BPE file, so call it off the request path
+    (e.g. from a gunicorn post_worker_init hook).
+    """
+    counter = estimate_tokens
+    if tiktoken is not None:
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("o200k_base")
+            counter = lambda text: len(encoding.encode(text or "", disallowed_special=()))  # noqa: E731
+        except Exception as e:
+            print(f"Tokenizer unavailable for {model}, estimating tokens: {e}")
+    with _lock:
+        _counters[model] = counter
+        _loading.discard(model)
+    return counter
+
+
+def get_token_counter(model):
+    """
+    Token counter for `model`: tiktoken when it is installed and its encoding is loaded, otherwise
+    the four-characters-per-token estimate used for conversation history. Never waits for the
+    encoding: the first call starts loading it on a background thread and gets the estimate.
+    """
+    if tiktoken is None:
+        return estimate_tokens
+    with _lock:
+        counter = _counters.get(model)
+        start = counter is None and model not in _loading
+        if start:
+            _loading.add(model)
+    if start:
+        threading.Thread(target=load_token_counter, args=(model,), name="token-counter", daemon=True).start()
+    return counter or estimate_tokens
+
+
+def normalise_fact(fact):
+    return re.sub(r"\s+", " ", str(fact)).strip().casefold()
+
+
+def pack_context(facts, token_budget, count_tokens):
+    """
+    Deduplicate facts (already ordered best source node first) and keep, in that order, those that
+    fit in `token_budget` tokens once rendered as one bullet per line.
+    Returns the rendered context and the token accounting against the unpacked list repr.
+    """
+    seen, unique = set(), []
+    for fact in facts:
+        key = normalise_fact(fact)
+        if key and key not in seen:
+            seen.add(key)
+            unique.append(str(fact).strip())
+
+    lines, used = [], 0
+    for fact in unique:
+        line = f"- {fact}"
+        cost = count_tokens(line + "\n")
+        if used + cost > token_budget:
+            continue
+        lines.append(line)
+        used += cost
+
+    context = "\n".join(lines)
+    raw_tokens = count_tokens(str(list(facts)))
+    packed_tokens = count_tokens(context)
+    stats = {"facts": len(facts), "unique_facts": len(unique), "packed_facts": len(lines),
+             "raw_tokens": raw_tokens, "context_tokens": packed_tokens,
+             "tokens_saved": max(raw_tokens - packed_tokens, 0)}
+    return context, stats
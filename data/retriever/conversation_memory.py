@@ -0,0 +1,128 @@
+import time
+import itertools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token) used for the history budget."""
+    return len(text or "") // 4 + 1
+
+
+class ConversationMemory:
+    """
+    Bounded, per-ChatSession conversation history.
+
+    With a `loader(session_id, limit)` (e.g. reading the Chat table; messages oldest first, each
+    with its row `id`), recent turns are re-read on every call, so each worker process sees the
+    turns written, and sessions deleted, through the others; only the running summary of older
+    turns is cached per worker. Without a loader, the turns passed to `append` are kept in memory.
+
+    The history is at most `window_turns` recent messages within `token_budget`, after the summary.
+    Older messages among the last 2 * `window_turns` are folded into the summary with
+    `summarise(summary, messages)` on a background thread, so no request waits for it; until it
+    finishes they stay in the history as they are. Sessions idle for longer than `idle_ttl` seconds,
+    or beyond `max_sessions`, are evicted least recently used first, so worker memory stays flat
+    under sustained traffic. A `session_id` of None has no history: nothing is read or kept for it.
+    """
+
+    def __init__(self, window_turns=12, token_budget=2000, idle_ttl=1800, max_sessions=1000,
+                 loader=None, summarise=None):
+        self.window_turns = window_turns
+        self.token_budget = token_budget
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.loader = loader
+        self.summarise = summarise
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._summariser = None
+        self._ids = itertools.count(1)
+
+    def _session(self, session_id):
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                # `summarised_through`: id of the newest message folded into the summary
+                entry = {"turns": deque(maxlen=2 * self.window_turns), "summary": "", "summarised_through": 0,
+                         "summarising": False}
+                self._sessions[session_id] = entry
+            entry["last_used"] = now
+            self._sessions.move_to_end(session_id)
+            self._evict(now)
+        return entry
+
+    def _evict(self, now):
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - entry["last_used"] <= self.idle_ttl:
+                break
+            del self._sessions[session_id]
+
+    def history(self, session_id):
+        if session_id is None:
+            return []
+        entry = self._session(session_id)
+        recent = None
+        if self.loader is not None:
+            recent = self.loader(session_id, 2 * self.window_turns)
+            if not recent:
+                # A new session, or one deleted through another worker: no summary applies
+                self.forget(session_id)
+                return []
+
+        with self._lock:
+            if recent is None:
+                recent = list(entry["turns"])
+            window = recent[-self.window_turns:]
+            # Move the oldest turns out of the window while it is over its token budget
+            while len(window) > 2 and sum(estimate_tokens(msg["content"]) for msg in window) > self.token_budget:
+                window = window[1:]
+            pending = []
+            if self.summarise is not None:
+                pending = [msg for msg in recent[:len(recent) - len(window)]
+                           if msg["id"] > entry["summarised_through"]]
+            summary = entry["summary"]
+            fold = bool(pending) and not entry["summarising"]
+            if fold:
+                entry["summarising"] = True
+                if self._summariser is None:
+                    self._summariser = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+        if fold:
+            self._summariser.submit(self._fold, entry, pending)
+
+        messages = [{"role": msg["role"], "content": msg["content"]} for msg in pending + window]
+        if summary:
+            messages.insert(0, {"role": "system", "content": f"Summary of earlier conversation: {summary}"})
+        return messages
+
+    def append(self, session_id, role, content):
+        """Record a turn; with a loader the store it reads from is the record, so nothing is kept."""
+        if session_id is None or self.loader is not None:
+            return
+        entry = self._session(session_id)
+        with self._lock:
+            entry["turns"].append({"id": next(self._ids), "role": role, "content": content})
+
+    def _fold(self, entry, batch):
+        """Fold `batch` into the summary; a later history call picks up whatever overflowed meanwhile."""
+        try:
+            summary = self.summarise(entry["summary"], batch)
+        except Exception as ex:
+            # Keep the turns pending; the next history call of this session retries
+            print(f"Summarising conversation history failed: {ex}")
+            summary = None
+        with self._lock:
+            if summary is not None:
+                entry["summary"], entry["summarised_through"] = summary, batch[-1]["id"]
+            entry["summarising"] = False
+
+    def forget(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,156 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def normalise_query(text):
+    """Collapse case and whitespace so trivially different spellings share a cache entry."""
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache for query embeddings.
+
+    Tier 1 is an in-process LRU. Tier 2 is a SQLite file storing float32 blobs; it survives
+    restarts and, in WAL mode, is shared by every worker process on the host. Both tiers are
+    keyed by (embedding model, normalised query) and honour the same TTL.
+
+    The file is opened on first use. Expired and least recently used rows are trimmed once every
+    `trim_every` writes of a process (default: 1% of `disk_capacity`), not on every write, so the
+    file may briefly hold that many rows per worker beyond `disk_capacity`.
+    """
+
+    def __init__(self, db_path, memory_capacity=1024, disk_capacity=100000, ttl_seconds=7 * 24 * 3600,
+                 trim_every=None):
+        self.db_path = db_path
+        self.memory_capacity = memory_capacity
+        self.disk_capacity = disk_capacity
+        self.ttl_seconds = ttl_seconds
+        self.trim_every = trim_every or max(1, disk_capacity // 100)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._writes_since_trim = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared across threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS query_embeddings (
+                        model TEXT NOT NULL,
+                        query TEXT NOT NULL,
+                        vector BLOB NOT NULL,
+                        created_at REAL NOT NULL,
+                        accessed_at REAL NOT NULL,
+                        PRIMARY KEY (model, query)
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_query_embeddings_accessed ON query_embeddings (accessed_at)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, model, query):
+        return self.lookup(model, query)[0]
+
+    def lookup(self, model, query):
+        """Return (vector or None, "memory_hit" | "disk_hit" | "miss")."""
+        key = (model, normalise_query(query))
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0], "memory_hit"
+
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT vector, created_at FROM query_embeddings WHERE model = ? AND query = ? AND created_at > ?",
+                (key[0], key[1], now - self.ttl_seconds)
+            ).fetchone()
+            if row is not None:
+                with conn:
+                    conn.execute("UPDATE query_embeddings SET accessed_at = ? WHERE model = ? AND query = ?",
+                                 (now, key[0], key[1]))
+        except sqlite3.Error as e:
+            print(f"Embedding cache read error: {e}")
+            row = None
+
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None, "miss"
+
+        vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, vector, row[1])
+        return vector, "disk_hit"
+
+    def put(self, model, query, vector):
+        key = (model, normalise_query(query))
+        now = time.time()
+        with self._lock:
+            self._remember(key, vector, now)
+            self._writes_since_trim += 1
+            trim = self._writes_since_trim >= self.trim_every
+            if trim:
+                self._writes_since_trim = 0
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?, ?)",
+                    (key[0], key[1], np.asarray(vector, dtype=np.float32).tobytes(), now, now)
+                )
+            if trim:
+                self._trim(conn, now)
+        except sqlite3.Error as e:
+            print(f"Embedding cache write error: {e}")
+
+    def _trim(self, conn, now):
+        with conn:
+            # Expired rows, then the least recently used rows beyond capacity
+            conn.execute("DELETE FROM query_embeddings WHERE created_at <= ?", (now - self.ttl_seconds,))
+            conn.execute("""
+                DELETE FROM query_embeddings WHERE rowid IN (
+                    SELECT rowid FROM query_embeddings ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.disk_capacity,))
+
+    def _remember(self, key, vector, created_at):
+        self._memory[key] = (vector, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_capacity:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "lookups": lookups,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
@@ -1,21 +1,79 @@
-import openai
 import os
+import time
+import asyncio
 import numpy as np
 from dotenv import load_dotenv
-from neo4j import GraphDatabase
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from data.constants import schema_description, problem_context_rel_types, problem_context_doc
+from data.clients import get_driver, get_openai_client
+from data.retriever.embedding_cache import EmbeddingCache, normalise_query
+from data.retriever.conversation_memory import ConversationMemory
+from data.retriever.vector_index import LocalVectorIndex
+from data.retriever.label_router import LabelRouter
+from data.retriever.context_packer import get_token_counter, pack_context
+from data.retriever.sparse_index import SparseIndexStore, build_from_neo4j
+from data.retriever.answer_cache import SemanticAnswerCache
+from data.graph_version import read_graph_version
+from data.embedding_profile import embedding_request, profile_name, profile_suffix, vector_index_name
+from data.retriever.tracing import trace, span, annotate, count, submit_traced
+
 load_dotenv()
-uri = os.getenv("NEO4J_URI")
-username = os.getenv("NEO4J_USERNAME")
-password = os.getenv("NEO4J_PASSWORD")
-driver = GraphDatabase.driver(uri, auth=(username, password))
-openai.api_key = os.getenv("OPENAI_API_KEY")
-embedding_model = os.getenv("EMBEDDING_MODEL")
-top_k = int(os.getenv("top_k"))
-threshold = float(os.getenv("threshold"))
-model = os.getenv("model")
-alpha = float(os.getenv("alpha"))
+embedding_profile = profile_name()
+top_k = int(os.getenv("top_k", "5"))
+threshold = float(os.getenv("threshold", "0.5"))
+model = os.getenv("model", "gpt-4o")
+alpha = float(os.getenv("alpha", "0.5"))
+retrieval_mode = os.getenv("RETRIEVAL_MODE", "fanout")
+retrieval_labels = ['SuspectArea', 'Symptom']
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Follow-ups: how long the answer waits, once the original query's retrieval is done, for the rephrased one
+rephrase_deadline = float(os.getenv("REPHRASE_DEADLINE", "0.5"))
+# Not asyncio's default executor, which asyncio.run joins on exit: a rephrase that misses the
+# deadline finishes in the background without holding up the answer
+rephrase_executor = ThreadPoolExecutor(max_workers=int(os.getenv("REPHRASE_WORKERS", "8")))
+
+embedding_cache = EmbeddingCache(
+    os.getenv("EMBEDDING_CACHE_PATH", ".cache/query_embeddings.sqlite3"),
+    memory_capacity=int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "1024")),
+    disk_capacity=int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", "100000")),
+    ttl_seconds=int(os.getenv("EMBEDDING_CACHE_TTL", str(7 * 24 * 3600)))
+)
+
+# Optional in-process BM25 index over node names, shared with ingestion through SPARSE_INDEX_PATH
+sparse_engine = os.getenv("SPARSE_ENGINE", "lucene")
+sparse_index_store = SparseIndexStore(os.getenv("SPARSE_INDEX_PATH", ".cache/sparse_index.pkl"))
+
+# Optional in-process vector engine; labels without a snapshot of the current graph version fall back to Neo4j
+vector_engine = os.getenv("VECTOR_ENGINE", "neo4j")
+local_vector_index = LocalVectorIndex(
+    os.getenv("VECTOR_SNAPSHOT_DIR", ".cache/vector_snapshots"),
+    max_age_seconds=int(os.getenv("VECTOR_SNAPSHOT_MAX_AGE", "86400")),
+    nprobe=int(os.getenv("VECTOR_IVF_NPROBE", "8")),
+    version_source=read_graph_version,
+    profile=embedding_profile
+)
+
+# Per-query label selection from snapshot centroids; falls back to retrieval_labels without snapshots.
+# Off by default until routed recall is validated on real embeddings, not only the offline corpus.
+label_routing = os.getenv("LABEL_ROUTING", "fixed")
+label_router = LabelRouter(
+    local_vector_index,
+    labels=os.getenv("ROUTER_LABELS", "Symptom,SuspectArea,Procedures,TestProcedures,AdditionalInfo,"
+                                      "SubComponent,BasicInfo,Problem").split(","),
+    max_labels=int(os.getenv("ROUTER_MAX_LABELS", "3")),
+    min_score=float(os.getenv("ROUTER_MIN_SCORE", "0.0")),
+    fallback=retrieval_labels
+)
+
+# Final answers for standalone questions, cleared whenever ingestion bumps the graph version
+answer_cache_enabled = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+answer_cache = SemanticAnswerCache(
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+    capacity=int(os.getenv("ANSWER_CACHE_SIZE", "1000")),
+    ttl_seconds=int(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    version_source=read_graph_version
+)
 
 
 # Escape Lucene special characters
@@ -27,42 +85,96 @@ def escape_lucene_query(query):
 def execute_query(query, parameters=None):
     """Executes a Cypher query on Neo4j with error handling."""
     try:
-        with driver.session() as session:
+        with get_driver().session() as session:
             session.run(query, parameters or {})
     except Exception as e:
         print(f"Error executing query: {query}\nError: {e}")
 
 
-# Stores previous interactions
-vChatHistory = []
-
-
 def get_latest_bot_content(chat_history):
     """Get the latest assistant message from the chat history."""
     return next((msg["content"] for msg in reversed(chat_history) if msg["role"] == "assistant"), "")
 
 
+def summarise_turns(summary, messages):
+    """Fold older conversation turns into the running summary kept by conversation_memory."""
+    turns = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    prompt = f"""
+    Update the summary of a vehicle troubleshooting conversation with the turns below.
+    Keep the vehicle, components, symptoms and any numerical values mentioned. Reply with the summary only, in at most 120 words.
+
+    Current summary: {summary or "(none)"}
+    New turns:
+    {turns}
+    """
+    with span("summarise"):
+        return get_openai_response(prompt) or summary
+
+
+# Stores previous interactions per chat session; app.py installs a loader backed by the Chat table
+conversation_memory = ConversationMemory(
+    window_turns=int(os.getenv("HISTORY_WINDOW_TURNS", "12")),
+    token_budget=int(os.getenv("HISTORY_TOKEN_BUDGET", "2000")),
+    idle_ttl=int(os.getenv("HISTORY_IDLE_TTL", "1800")),
+    max_sessions=int(os.getenv("HISTORY_MAX_SESSIONS", "1000")),
+    summarise=summarise_turns
+)
+
+
 def get_openai_response(prompt):
     """Generate a response from OpenAI GPT-4o based on the given prompt."""
     try:
-        response = openai.chat.completions.create(
+        response = get_openai_client().chat.completions.create(
             model=model,
             messages=[{"role": "user", "content": prompt}]
         )
+        if getattr(response, "usage", None):
+            count(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
         return response.choices[0].message.content
     except Exception as ex:
         print(f"Exception in getting OpenAI response: {ex}")
         return ""
 
 
-def get_openai_embedding(text):
-    """Generate an embedding vector for a given text using OpenAI embeddings API."""
+def get_openai_response_stream(prompt):
+    """
+    Stream a response from OpenAI, yielding content deltas as they arrive. Errors are logged and
+    re-raised, so callers can tell a truncated answer from a complete one.
+    """
     try:
-        response = openai.embeddings.create(input=text, model=embedding_model)
-        return response.data[0].embedding
-    except Exception as e:
-        print(f"Embedding error: {e}")
-        return None
+        stream = get_openai_client().chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if getattr(chunk, "usage", None):
+                count(prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens)
+    except Exception as ex:
+        print(f"Exception in streaming OpenAI response: {ex}")
+        raise
+
+
+def get_openai_embedding(text):
+    """Generate an embedding vector for a given text, served from the query embedding cache when possible."""
+    with span("embed") as stage:
+        cached, result = embedding_cache.lookup(embedding_profile, text)
+        stage.set(cached=cached is not None, embedding_cache=result)
+        if cached is not None:
+            return cached
+        try:
+            response = get_openai_client().embeddings.create(input=text, **embedding_request())
+            if getattr(response, "usage", None):
+                count(prompt_tokens=response.usage.prompt_tokens)
+            vector = response.data[0].embedding
+            embedding_cache.put(embedding_profile, text, vector)
+            return vector
+        except Exception as e:
+            print(f"Embedding error: {e}")
+            return None
 
 
 def rephrase(user_query, chat_history):
@@ -77,60 +189,63 @@ def rephrase(user_query, chat_history):
 
     Warning: Do not explain anything
     """
-    return get_openai_response(prompt)
+    with span("rephrase"):
+        return get_openai_response(prompt)
 
 
 def get_related_nodes(node_name, node_type):
-    """Find related nodes based on whether the node is a Problem or a child node."""
+    """Children of the Problem, or of every Problem the node belongs to, read from their context documents."""
     try:
-        with driver.session() as session:
+        with get_driver().session() as session:
             if node_type == "Problem":
-                query = """
-                MATCH (p:Problem {name: $node_name})-[:HAS_PROCEDURES|:HAS_SUBCOMPONENT|:HAS_TESTPROCEDURES
-                     |:HAS_SUBPROBLEM|:HAS_ADDITIONALINFO|:HAS_SYMPTOM
-                     |:HAS_SUSPECTAREA|:HAS_BASICINFO]->(child)
-                RETURN labels(child) AS child_type, child.name AS child_name
+                query = f"""
+                MATCH (problem:Problem {{name: $node_name}})
+                RETURN {problem_context_doc('problem')} AS doc
                 """
-                result = session.run(query, node_name=node_name)
-                return [{"node_type": record["child_type"][0], "name": record["child_name"]} for record in result]
             else:
-                query = """
-                MATCH (problem:Problem)-[:HAS_PROCEDURES|:HAS_SUBCOMPONENT|:HAS_TESTPROCEDURES
-                     |:HAS_SUBPROBLEM|:HAS_ADDITIONALINFO|:HAS_SYMPTOM
-                     |:HAS_SUSPECTAREA|:HAS_BASICINFO]->(child {name: $node_name})
-                WITH problem
-                MATCH (problem)-[:HAS_PROCEDURES|:HAS_SUBCOMPONENT|:HAS_TESTPROCEDURES
-                     |:HAS_SUBPROBLEM|:HAS_ADDITIONALINFO|:HAS_SYMPTOM
-                     |:HAS_SUSPECTAREA|:HAS_BASICINFO]->(related_child)
-                RETURN labels(problem) AS problem_type, problem.name AS problem_name, 
-                       labels(related_child) AS child_type, related_child.name AS child_name
+                label = f":{node_type}" if node_type in schema_description else ""
+                query = f"""
+                MATCH (problem:Problem)-[:{problem_context_rel_types}]->(child{label} {{name: $node_name}})
+                RETURN {problem_context_doc('problem')} AS doc
                 """
-                result = session.run(query, node_name=node_name)
-                related_nodes = []
-                for record in result:
-                    related_nodes.append({"node_type": record["child_type"][0], "name": record["child_name"]})
-                return related_nodes
+            related_nodes = []
+            for record in session.run(query, node_name=node_name):
+                for line in record["doc"]:
+                    child_type, _, child_name = line.partition(": ")
+                    related_nodes.append({"node_type": child_type, "name": child_name})
+            return related_nodes
     except Exception as e:
         print(f"Error retrieving related nodes: {e}")
         return []
         
 
 def process_top_nodes(results):
-    """Process the top retrieved nodes and find their related nodes in parallel."""
-    content = []
+    """
+    Find the related nodes of the top retrieved nodes in parallel. Content is returned in the
+    ranking order of the node it came from, so the best-scored facts come first; duplicates are
+    left for pack_context to drop.
+    """
+    related_by_rank = {}
 
     def fetch_related(node):
-        related = get_related_nodes(node["name"], node["node_type"][0])
+        # Vector hits carry labels(node), fulltext and BM25 hits a single label string
+        node_type = node["node_type"] if isinstance(node["node_type"], str) else node["node_type"][0]
+        with span("related_nodes") as stage:
+            related = get_related_nodes(node["name"], node_type)
+            stage.set(results=len(related))
         return [f"{rel['node_type']}: {rel['name']}" for rel in related]
 
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = [executor.submit(fetch_related, node) for node in results]
+    with span("expand") as stage:
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            futures = {submit_traced(executor, fetch_related, node): rank for rank, node in enumerate(results)}
 
-        for future in as_completed(futures):
-            try:
-                content.extend(future.result())
-            except Exception as e:
-                print(f"Error processing node relationships: {e}")
+            for future in as_completed(futures):
+                try:
+                    related_by_rank[futures[future]] = future.result()
+                except Exception as e:
+                    print(f"Error processing node relationships: {e}")
+        content = [fact for rank in sorted(related_by_rank) for fact in related_by_rank[rank]]
+        stage.set(results=len(content))
 
     return content
 
@@ -139,9 +254,19 @@ def vector_search(driver, node_label, query_vector):
     """Retrieve top-k similar nodes from Neo4j vector index."""
     if query_vector is None:
         return []
+    if vector_engine == "local":
+        try:
+            hits = local_vector_index.search(node_label, query_vector, top_k, threshold)
+        except Exception as e:
+            # e.g. a snapshot file removed or truncated under this worker; Neo4j still has the vectors
+            print(f"Local vector search error, querying Neo4j: {e}")
+            hits = None
+        if hits is not None:
+            annotate(engine="local")
+            return [{"name": name, "node_type": [node_label], "score": round(alpha * score, 4)} for name, score in hits]
     try:
         query_vector = np.array(query_vector, dtype=np.float32).tolist()
-        index_name = f'vectorIndex_{node_label}'
+        index_name = vector_index_name(node_label, embedding_profile)
         cypher_query = """
         CALL db.index.vector.queryNodes(
             $index_name,
@@ -182,26 +307,69 @@ def fulltext_search(driver, node_label, query_text):
                 results]
 
 
+# Local BM25 search across labels
+def local_sparse_search(query_text, labels):
+    """
+    Score all labels in one BM25 lookup. Scores share corpus statistics, so they are
+    normalised by the best hit across every label rather than per label.
+    """
+    with span("sparse_search", engine="bm25") as stage:
+        index = sparse_index_store.get(build=lambda: build_from_neo4j(get_driver(), schema_description))
+        hits = index.search(query_text, labels, top_k) if index is not None else []
+        stage.set(results=len(hits))
+    results = {label: [] for label in labels}
+    if hits:
+        max_score = hits[0][2]
+        for label, name, score in hits:
+            results[label].append({"name": name, "node_type": label, "score": round((1 - alpha) * score, 4),
+                                   "confidence_score": round((1 - alpha) * score / max_score, 4)})
+    return results
+
+
+def timed_search(stage_name, search, driver, node_label, query):
+    """Run one dense or sparse search inside a span recording its label and result count."""
+    with span(stage_name, label=node_label) as stage:
+        results = search(driver, node_label, query)
+        stage.set(results=len(results))
+        return results
+
+
+def select_labels(query_vector):
+    """Labels to search for this query: routed by centroid similarity, or the fixed retrieval_labels."""
+    if label_routing != "centroid":
+        return retrieval_labels
+    with span("route") as stage:
+        labels, scores = label_router.route(query_vector)
+        stage.set(labels=labels, scores=scores, fallback=not scores)
+    return labels
+
+
 # Hybrid retrieval using ThreadPoolExecutor
-def hybrid_search(driver, query_text, query_vector, node_label):
+def hybrid_search(driver, query_text, query_vector, node_label, fulltext_result=None):
+    """Merge dense and sparse hits for a label; pre-scored sparse hits skip the fulltext call."""
     with ThreadPoolExecutor() as executor:
-        future_vector = executor.submit(vector_search, driver, node_label, query_vector)
-        future_fulltext = executor.submit(fulltext_search, driver, node_label, query_text)
+        future_vector = submit_traced(executor, timed_search, "vector_search", vector_search, driver, node_label,
+                                      query_vector)
+        future_fulltext = None
+        if fulltext_result is None:
+            future_fulltext = submit_traced(executor, timed_search, "fulltext_search", fulltext_search, driver,
+                                            node_label, query_text)
 
         vector_result = future_vector.result()
-        fulltext_result = future_fulltext.result()
+        if future_fulltext is not None:
+            fulltext_result = future_fulltext.result()
+
+            # Normalize fulltext scores (scale relative to max)
+            if fulltext_result:
+                max_text_score = max(r["score"] for r in fulltext_result)
+                for r in fulltext_result:
+                    normalized_score = r["score"] / max_text_score if max_text_score else 0
+                    r["confidence_score"] = round((1 - alpha) * normalized_score, 4)
 
     # Normalize vector scores (already in 0-1 range), so multiply directly
     for r in vector_result:
         r["confidence_score"] = round(alpha * r["score"], 4)
 
-    # Normalize fulltext scores (scale relative to max)
-    if fulltext_result:
-        max_text_score = max(r["score"] for r in fulltext_result)
-        for r in fulltext_result:
-            normalized_score = r["score"] / max_text_score if max_text_score else 0
-            r["confidence_score"] = round((1 - alpha) * normalized_score, 4)
-
     # Merge and deduplicate by node.name
     merged = vector_result + fulltext_result
     seen, final = set(), []
@@ -221,36 +389,120 @@ def retrieve_data(user_query):
     if query_vector is None:
         return []
 
-    all_results = []
-
-    # Run hybrid_search in parallel for all labels
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = {
-            executor.submit(hybrid_search, driver, user_query, query_vector, label): label
-            for label in ['SuspectArea', 'Symptom']
-        }
-
-        for future in as_completed(futures):
-            try:
-                all_results.extend(future.result())
-            except Exception as e:
-                print(f"Search failed for label {futures[future]}: {e}")
-
-    # Deduplicate and sort by hybrid confidence score
-    seen, final_results = set(), []
-    for result in sorted(all_results, key=lambda x: x.get("confidence_score", 0), reverse=True):
-        node_name = result.get("name")
-        if node_name and node_name not in seen:
-            seen.add(node_name)
-            final_results.append(result)
+    with span("retrieve") as stage:
+        all_results = []
+        labels = select_labels(query_vector)
+        sparse_results = local_sparse_search(user_query, labels) if sparse_engine == "bm25" else {}
+
+        # Run hybrid_search in parallel for all labels
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            futures = {
+                submit_traced(executor, hybrid_search, get_driver(), user_query, query_vector, label,
+                              sparse_results.get(label)): label
+                for label in labels
+            }
+
+            for future in as_completed(futures):
+                try:
+                    all_results.extend(future.result())
+                except Exception as e:
+                    print(f"Search failed for label {futures[future]}: {e}")
+
+        # Deduplicate and sort by hybrid confidence score
+        seen, final_results = set(), []
+        for result in sorted(all_results, key=lambda x: x.get("confidence_score", 0), reverse=True):
+            node_name = result.get("name")
+            if node_name and node_name not in seen:
+                seen.add(node_name)
+                final_results.append(result)
+
+        stage.set(results=len(final_results[:top_k]))
+        return final_results[:top_k]
+
+
+
+# Single round trip: vector + fulltext search, score fusion and context-document expansion in one query
+
+single_trip_query = f"""
+UNWIND $labels AS label
+CALL {{
+    WITH label
+    CALL db.index.vector.queryNodes('vectorIndex_' + label + '{profile_suffix(embedding_profile)}', $top_k, $query_vector)
+    YIELD node, score
+    WITH node, score WHERE score >= $threshold
+    RETURN node, $alpha * score AS confidence_score
+  UNION ALL
+    WITH label
+    CALL db.index.fulltext.queryNodes('search_' + label, $query_text) YIELD node, score
+    WITH node, score LIMIT $top_k
+    WITH collect({{node: node, score: score}}) AS hits, max(score) AS max_score
+    UNWIND hits AS hit
+    RETURN hit.node AS node,
+           CASE WHEN max_score > 0 THEN (1 - $alpha) * hit.score / max_score ELSE 0.0 END AS confidence_score
+}}
+WITH node, max(confidence_score) AS confidence_score
+ORDER BY confidence_score DESC
+LIMIT $top_k
+CALL {{
+    WITH node
+    OPTIONAL MATCH (parent:Problem)-[:{problem_context_rel_types}]->(node) WHERE NOT node:Problem
+    WITH node, collect(parent) AS parents
+    WITH CASE WHEN node:Problem THEN [node] ELSE parents END AS problems
+    RETURN reduce(doc = [], problem IN problems | doc + {problem_context_doc('problem')}) AS related
+}}
+RETURN labels(node) AS node_type, node.name AS name, round(confidence_score, 4) AS confidence_score, related
+ORDER BY confidence_score DESC
+"""
 
-    return final_results[:top_k]
 
+def retrieve_single_trip(user_query, labels=None):
+    """
+    Run hybrid search and graph expansion for all labels in one Cypher call.
+    Returns the same (results, content) pair as retrieve_data + process_top_nodes.
+    """
+    query_vector = get_openai_embedding(user_query)
+    if query_vector is None:
+        return [], []
+    try:
+        with span("single_trip") as stage, get_driver().session() as session:
+            records = list(session.run(
+                single_trip_query,
+                labels=labels or select_labels(query_vector),
+                query_text=escape_lucene_query(user_query),
+                query_vector=np.array(query_vector, dtype=np.float32).tolist(),
+                top_k=top_k,
+                threshold=threshold,
+                alpha=alpha
+            ))
+            stage.set(results=len(records))
+    except Exception as e:
+        print(f"Single-trip retrieval error: {e}")
+        return [], []
+
+    seen, results, content = set(), [], []
+    for record in records:
+        if record["name"] in seen:
+            continue
+        seen.add(record["name"])
+        results.append({"name": record["name"], "node_type": record["node_type"],
+                        "confidence_score": record["confidence_score"]})
+        content.extend(record["related"])
+    return results, content
+
+
+def retrieve_context(user_query, mode=None):
+    """Retrieve top nodes and their related content using the configured retrieval mode."""
+    if (mode or retrieval_mode) == "single":
+        return retrieve_single_trip(user_query)
+    retrieved_results = retrieve_data(user_query)
+    return retrieved_results, process_top_nodes(retrieved_results)
 
 
-def final_call(user_query, content):
-    """Generate the final LLM response using the retrieved context and rephrased query."""
-    prompt = f"""
+def build_final_prompt(user_query, content):
+    with span("pack_context") as stage:
+        context, stats = pack_context(content, context_token_budget, get_token_counter(model))
+        stage.set(**stats)
+    return f"""
 Act as an Automobile Service Agent and answer the user's query based on structured Data.
 
 ### Context Information
@@ -269,7 +521,7 @@ Don't miss out the numerical values if relevant to the User Query
 - Use the following content to generate a helpful response to answer the User Query in a structured manner:
 
 Content:
-{content}
+{context}
 
 User Query:
 {user_query}
@@ -280,23 +532,129 @@ Strict Constraints:
 - Don't give long responses. Ensure responses are clear, concise, and helpful.
 - Give final response in a clear Markdown structure
 """
-    return get_openai_response(prompt)
 
 
-def rag_advisor(user_query):
-    """Main entry point: handles chat history, rephrasing, retrieval, and LLM generation."""
-    global vChatHistory
-    vChatHistory.append({"role": "user", "content": user_query})
+def final_call(user_query, content):
+    """Generate the final LLM response using the retrieved context and rephrased query."""
+    with span("generate"):
+        return get_openai_response(build_final_prompt(user_query, content))
 
-    retrieved_results = retrieve_data(user_query)
-    content = process_top_nodes(retrieved_results)
 
-    if vChatHistory:
-        user_query = rephrase(user_query, get_latest_bot_content(vChatHistory))
+def final_call_stream(user_query, content):
+    """Stream the final LLM response token by token."""
+    return get_openai_response_stream(build_final_prompt(user_query, content))
 
-    response = final_call(user_query, content)
-    vChatHistory.append({"role": "assistant", "content": f"user_query:{user_query},response:{response}"})
-    return response
+
+def merge_retrieval(primary, secondary):
+    """Merge two (results, content) pairs: best score per node name, content deduplicated in order."""
+    best = {}
+    for result in primary[0] + secondary[0]:
+        name = result.get("name")
+        if name not in best or result.get("confidence_score", 0) > best[name].get("confidence_score", 0):
+            best[name] = result
+    results = sorted(best.values(), key=lambda x: x.get("confidence_score", 0), reverse=True)[:top_k]
+    content = list(dict.fromkeys(primary[1] + secondary[1]))
+    return results, content
+
+
+def rephrase_and_retrieve(user_query, chat_history):
+    """Rephrase against the conversation so far, then retrieve with the rephrased query if it differs."""
+    rephrased = rephrase(user_query, chat_history).strip() or user_query
+    if normalise_query(rephrased) == normalise_query(user_query):
+        return rephrased, None
+    return rephrased, retrieve_context(rephrased)
+
+
+async def prepare_context_async(user_query, chat_history):
+    """
+    Async pipeline: rephrasing and retrieval for the rephrased query start alongside retrieval for
+    the original query. Once the original retrieval is done, the rephrased query and its results are
+    used only if they arrive within `rephrase_deadline` seconds, so a follow-up waits at most that long
+    for the rephrase LLM round trip. Rephrasing is skipped when there is no earlier assistant turn to
+    resolve references against.
+    Returns the (possibly rephrased) query and the retrieved content for final_call.
+    """
+    if not get_latest_bot_content(chat_history):
+        _, content = await asyncio.to_thread(retrieve_context, user_query)
+        return user_query, content
+
+    rendered_history = "\n".join(f"{msg['role']}: {msg['content']}" for msg in chat_history)
+    rephrasing = asyncio.wrap_future(submit_traced(rephrase_executor, rephrase_and_retrieve, user_query,
+                                                   rendered_history))
+    original = await asyncio.to_thread(retrieve_context, user_query)
+    done, _ = await asyncio.wait([rephrasing], timeout=rephrase_deadline)
+    if not done or rephrasing.exception() is not None:
+        # Detach from the loop; the thread runs to completion and its result is dropped
+        rephrasing.cancel()
+        annotate(rephrase="late" if not done else "failed")
+        return user_query, original[1]
+
+    annotate(rephrase="merged")
+    user_query, rephrased = rephrasing.result()
+    _, content = merge_retrieval(rephrased, original) if rephrased else original
+    return user_query, content
+
+
+async def rag_advisor_async(user_query, chat_history):
+    user_query, content = await prepare_context_async(user_query, chat_history)
+    return await asyncio.to_thread(final_call, user_query, content)
+
+
+def answer_cache_vector(user_query, chat_history):
+    """
+    Embedding to key the answer cache with, or None when the turn must not be cached.
+    Follow-ups depend on the conversation, so only turns without a previous answer are cached.
+    """
+    if not answer_cache_enabled or get_latest_bot_content(chat_history):
+        return None
+    return get_openai_embedding(user_query)
+
+
+def rag_advisor(user_query, session_id=None):
+    """Main entry point: handles chat history, rephrasing, retrieval, and LLM generation. Without a session_id no history is used or kept."""
+    with trace("rag_advisor"):
+        chat_history = conversation_memory.history(session_id)
+        conversation_memory.append(session_id, "user", user_query)
+        with span("answer_cache") as stage:
+            cache_vector = answer_cache_vector(user_query, chat_history)
+            response = answer_cache.lookup(cache_vector)
+            stage.set(hit=response is not None)
+        if response is None:
+            response = asyncio.run(rag_advisor_async(user_query, chat_history))
+            answer_cache.store(cache_vector, response)
+        conversation_memory.append(session_id, "assistant", response)
+        return response
+
+
+def rag_advisor_stream(user_query, session_id=None):
+    """Streaming entry point: same pipeline as rag_advisor, yielding answer tokens as they arrive."""
+    with trace("rag_advisor_stream"):
+        chat_history = conversation_memory.history(session_id)
+        conversation_memory.append(session_id, "user", user_query)
+        with span("answer_cache") as stage:
+            cache_vector = answer_cache_vector(user_query, chat_history)
+            cached = answer_cache.lookup(cache_vector)
+            stage.set(hit=cached is not None)
+        if cached is not None:
+            conversation_memory.append(session_id, "assistant", cached)
+            yield cached
+            return
+        user_query, content = asyncio.run(prepare_context_async(user_query, chat_history))
+        tokens = []
+        try:
+            with span("generate") as generate:
+                for token in final_call_stream(user_query, content):
+                    if not tokens:
+                        generate.set(first_token_ms=round((time.perf_counter() - generate.started) * 1000, 3))
+                    tokens.append(token)
+                    yield token
+        except Exception as ex:
+            # The client keeps the partial answer, but a truncated answer is never cached
+            print(f"Streaming answer stopped after {len(tokens)} tokens: {ex}")
+        else:
+            answer_cache.store(cache_vector, "".join(tokens))
+        finally:
+            conversation_memory.append(session_id, "assistant", "".join(tokens))
 
 
 # if __name__ == "__main__":
@@ -0,0 +1,39 @@
+import numpy as np
+
+
+class LabelRouter:
+    """
+    Picks which label indexes to search for a query.
+
+    Each candidate label is summarised by a few k-means centroids of its vectors, trained when its
+    snapshot is built (LocalVectorIndex.label_centroids); a label scores the best cosine similarity
+    between the query embedding and its centroids. The top `max_labels` labels scoring at least
+    `min_score` are searched. Without any snapshot the router returns `fallback`.
+    """
+
+    def __init__(self, vector_index, labels, max_labels=3, min_score=0.0, fallback=()):
+        self.vector_index = vector_index
+        self.labels = list(labels)
+        self.max_labels = max_labels
+        self.min_score = min_score
+        self.fallback = list(fallback)
+
+    def scores(self, query_vector):
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = {}
+        for label in self.labels:
+            centroids = self.vector_index.label_centroids(label)
+            if centroids is not None and centroids.shape[1] == len(query):
+                scores[label] = round(float(np.max(centroids @ query)), 4)
+        return scores
+
+    def route(self, query_vector):
+        """Return (labels to search, score per candidate label); scores are empty on fallback."""
+        if query_vector is None:
+            return self.fallback, {}
+        scores = self.scores(query_vector)
+        ranked = [label for label in sorted(scores, key=scores.get, reverse=True) if scores[label] >= self.min_score]
+        if not ranked:
+            return self.fallback, scores
+        return ranked[:self.max_labels], scores
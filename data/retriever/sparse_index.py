@@ -0,0 +1,168 @@
+import os
+import re
+import math
+import heapq
+import pickle
+import threading
+from collections import Counter
+
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", (text or "").lower())
+
+
+class BM25Index:
+    """
+    In-process inverted index over node names for every label.
+
+    Term statistics (document frequency, average length) are shared by all labels, so BM25
+    scores from different labels in the same query are directly comparable. Documents can be
+    added or removed one at a time as ingestion changes the graph.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = []          # doc_id -> (label, name), None once removed
+        self.lengths = []       # doc_id -> token count
+        self.doc_ids = {}       # (label, name) -> doc_id
+        self.postings = {}      # term -> {doc_id: term frequency}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def add(self, label, name):
+        if not name or (label, name) in self.doc_ids:
+            return
+        tokens = tokenize(name)
+        doc_id = len(self.docs)
+        self.docs.append((label, name))
+        self.lengths.append(len(tokens))
+        self.doc_ids[(label, name)] = doc_id
+        self.total_length += len(tokens)
+        for term, tf in Counter(tokens).items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+
+    def remove(self, label, name):
+        doc_id = self.doc_ids.pop((label, name), None)
+        if doc_id is None:
+            return
+        for term in set(tokenize(name)):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self.postings[term]
+        self.total_length -= self.lengths[doc_id]
+        self.docs[doc_id] = None
+
+    def search(self, query_text, labels, top_k):
+        """Return up to `top_k` (label, name, score) hits per label, best first."""
+        if not self.doc_ids:
+            return []
+        labels = set(labels)
+        doc_count = len(self.doc_ids)
+        avg_length = self.total_length / doc_count or 1.0
+        scores = {}
+        for term in set(tokenize(query_text)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                if self.docs[doc_id][0] not in labels:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        by_label = {}
+        for doc_id, score in scores.items():
+            by_label.setdefault(self.docs[doc_id][0], []).append((score, doc_id))
+        hits = []
+        for label_scores in by_label.values():
+            for score, doc_id in heapq.nlargest(top_k, label_scores):
+                hits.append((self.docs[doc_id][0], self.docs[doc_id][1], score))
+        return sorted(hits, key=lambda hit: hit[2], reverse=True)
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{path}.tmp", "wb") as file:
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+
+def build_from_neo4j(driver, labels):
+    index = BM25Index()
+    with driver.session() as session:
+        for label in labels:
+            for record in session.run(f"MATCH (n:{label}) WHERE n.name IS NOT NULL RETURN n.name AS name"):
+                index.add(label, record["name"])
+    return index
+
+
+class SparseIndexStore:
+    """
+    Holds the shared index file for a process: loads it lazily, reloads it when another
+    process (e.g. ingestion) rewrites it, and applies incremental updates under a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def get(self, build=None):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if self._index is not None and mtime == self._mtime:
+            return self._index
+        with self._lock:
+            if mtime is not None:
+                self._index, self._mtime = BM25Index.load(self.path), mtime
+            elif build is not None:
+                self._index = build()
+                self._index.save(self.path)
+                self._mtime = os.stat(self.path).st_mtime
+        return self._index
+
+    def update(self, added=(), removed=()):
+        """
+        Apply (label, name) pairs added to and removed from the graph to the persisted index, if one
+        has been built. The file is rewritten once per call, so ingestion batches a whole run.
+        """
+        added, removed = list(added), list(removed)
+        with self._lock:
+            if not (added or removed) or not os.path.exists(self.path):
+                return
+            index = BM25Index.load(self.path)
+            for label, name in removed:
+                index.remove(label, name)
+            for label, name in added:
+                index.add(label, name)
+            index.save(self.path)
+            self._index, self._mtime = index, os.stat(self.path).st_mtime
+
+
+# -------------------------
+# Build the index from Neo4j
+# -------------------------
+if __name__ == "__main__":
+    from data.clients import get_driver, close_clients
+    from data.constants import schema_description
+
+    path = os.getenv("SPARSE_INDEX_PATH", ".cache/sparse_index.pkl")
+    index = build_from_neo4j(get_driver(), schema_description)
+    index.save(path)
+    print(f"BM25 index with {len(index)} documents written to {path}")
+    close_clients()
@@ -0,0 +1,345 @@
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))
+TRACE_WINDOW_SECONDS = int(os.getenv("TRACE_WINDOW_SECONDS", "300"))
+TRACE_WINDOW_SAMPLES = int(os.getenv("TRACE_WINDOW_SAMPLES", "2048"))
+# Directory shared by all worker processes; when set, /metrics reports the sum over every worker
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "1"))
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+logger = logging.getLogger("rag.trace")
+_current_span = contextvars.ContextVar("rag_current_span", default=None)
+
+
+class Span:
+    """One timed stage of a request. Attributes hold result counts and token usage."""
+
+    def __init__(self, name, attrs=None):
+        self.name = name
+        self.attrs = dict(attrs or {})
+        self.children = []
+        self.started = time.perf_counter()
+        self.duration_ms = None
+        self._lock = threading.Lock()
+
+    def set(self, **attrs):
+        with self._lock:
+            self.attrs.update(attrs)
+
+    def add(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                self.attrs[key] = self.attrs.get(key, 0) + (value or 0)
+
+    def _attach(self, child):
+        with self._lock:
+            self.children.append(child)
+
+    def walk(self):
+        yield self
+        for child in list(self.children):
+            yield from child.walk()
+
+    def to_dict(self):
+        return {"name": self.name, "duration_ms": self.duration_ms, **self.attrs,
+                "children": [child.to_dict() for child in self.children]}
+
+
+class RollingHistogram:
+    """
+    Cumulative Prometheus buckets plus the samples of the last `window_seconds`
+    (at most `max_samples`), from which recent quantiles are computed.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS, window_seconds=TRACE_WINDOW_SECONDS, max_samples=TRACE_WINDOW_SAMPLES):
+        self.buckets = buckets
+        self.window_seconds = window_seconds
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.observations = 0
+        self._recent = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        now = time.time()
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.total += value
+            self.observations += 1
+            self._recent.append((now, value))
+
+    def state(self):
+        """JSON-serialisable copy, with the timestamped recent samples so processes can be merged."""
+        cutoff = time.time() - self.window_seconds
+        with self._lock:
+            while self._recent and self._recent[0][0] < cutoff:
+                self._recent.popleft()
+            return {"counts": list(self.counts), "total": self.total, "observations": self.observations,
+                    "recent": [[round(at, 3), value] for at, value in self._recent]}
+
+
+class Metrics:
+    """
+    In-process stage histograms and counters. With METRICS_DIR set, a background thread writes
+    this process's state to its own file there every METRICS_FLUSH_SECONDS, and render_prometheus
+    merges the files of all processes, so every gunicorn worker reports the same totals. Files of
+    exited workers are kept so counters never go backwards; only their gauges are dropped.
+    """
+
+    def __init__(self, shared_dir=METRICS_DIR, flush_seconds=METRICS_FLUSH_SECONDS):
+        self.durations = {}
+        self.counters = {}
+        self.gauge_source = None
+        self.shared_dir = shared_dir
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._dirty = False
+        self._flusher_pid = None
+        self._path_pid = None
+        self._path = None
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.durations.setdefault(stage, RollingHistogram())
+            self._dirty = True
+        histogram.observe(seconds)
+        self._ensure_flusher()
+
+    def increment(self, name, labels=(), value=1):
+        with self._lock:
+            key = (name, tuple(labels))
+            self.counters[key] = self.counters.get(key, 0) + value
+            self._dirty = True
+        self._ensure_flusher()
+
+    def gauges(self):
+        return self.gauge_source() if self.gauge_source is not None else {}
+
+    def state(self, with_gauges=True):
+        """This process's metrics as plain data; gauges are {name: [help, [[labels, value], ...]]}."""
+        with self._lock:
+            durations = dict(self.durations)
+            counters = list(self.counters.items())
+        gauges = {}
+        for name, (help_text, value) in (self.gauges() if with_gauges else {}).items():
+            values = value if isinstance(value, dict) else {(): value}
+            gauges[name] = [help_text, [[[list(pair) for pair in labels], sample] for labels, sample in values.items()]]
+        return {"pid": os.getpid(),
+                "durations": {stage: histogram.state() for stage, histogram in durations.items()},
+                "counters": [[name, [list(pair) for pair in labels], value] for (name, labels), value in counters],
+                "gauges": gauges}
+
+    def flush(self, final=False):
+        """Write this process's state to its file in shared_dir; `final` drops the gauges of an exiting worker."""
+        if not self.shared_dir:
+            return
+        with self._flush_lock:
+            if self._path_pid != os.getpid():
+                # The start time keeps a reused pid from overwriting an exited worker's counters
+                self._path = os.path.join(self.shared_dir, f"metrics_{os.getpid()}_{time.time_ns()}.json")
+                self._path_pid = os.getpid()
+            self._dirty = False
+            os.makedirs(self.shared_dir, exist_ok=True)
+            tmp_path = self._path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(self.state(with_gauges=not final), file, separators=(",", ":"))
+            os.replace(tmp_path, self._path)
+
+    def _ensure_flusher(self):
+        # Started lazily, so it runs in the forked worker rather than the process that imported this module
+        if not self.shared_dir or self._flusher_pid == os.getpid():
+            return
+        with self._flush_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            if self._dirty:
+                try:
+                    self.flush()
+                except OSError as e:
+                    logger.warning("writing metrics to %s failed: %s", self.shared_dir, e)
+
+    def collect(self):
+        """States of every process sharing shared_dir (this one freshly flushed), or just this process."""
+        if not self.shared_dir:
+            return [self.state()]
+        self.flush()
+        states = []
+        for file_name in os.listdir(self.shared_dir):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.shared_dir, file_name), "r", encoding="utf-8") as file:
+                    states.append(json.load(file))
+            except (OSError, ValueError):
+                continue
+        return states
+
+    def record(self, root):
+        self.increment("rag_requests_total", (("pipeline", root.name),))
+        for span in root.walk():
+            if span.duration_ms is None:
+                continue
+            self.observe(span.name, span.duration_ms / 1000)
+            if span.name == "route":
+                for label in span.attrs.get("labels", []):
+                    self.increment("rag_routed_labels_total", (("label", label),))
+            if "embedding_cache" in span.attrs:
+                self.increment("rag_embedding_cache_lookups_total", (("result", span.attrs["embedding_cache"]),))
+            if span.attrs.get("tokens_saved"):
+                self.increment("rag_context_tokens_saved_total", (), span.attrs["tokens_saved"])
+            if "results" in span.attrs:
+                self.increment("rag_stage_results_total", (("stage", span.name),), span.attrs["results"])
+            for kind in ("prompt_tokens", "completion_tokens"):
+                if span.attrs.get(kind):
+                    self.increment("rag_tokens_total", (("stage", span.name), ("kind", kind.split("_")[0])),
+                                   span.attrs[kind])
+
+
+metrics = Metrics()
+
+
+def annotate(**attrs):
+    """Set attributes on the innermost open span, if any."""
+    span = _current_span.get()
+    if span is not None:
+        span.set(**attrs)
+
+
+def count(**counts):
+    """Add to counters (e.g. token usage) on the innermost open span, if any."""
+    span = _current_span.get()
+    if span is not None:
+        span.add(**counts)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time a stage as a child of the current span. Outside a trace this only measures."""
+    parent = _current_span.get()
+    current = Span(name, attrs)
+    if parent is not None:
+        parent._attach(current)
+    _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.set(error=str(e))
+        raise
+    finally:
+        current.duration_ms = round((time.perf_counter() - current.started) * 1000, 3)
+        # set() rather than reset(): generators may finish the span in another context
+        _current_span.set(parent)
+
+
+@contextmanager
+def trace(name, **attrs):
+    """Root span of a request; on exit its span tree feeds the metrics and, when slow, the log."""
+    with span(name, **attrs) as root:
+        yield root
+    metrics.record(root)
+    if TRACE_SLOW_MS and root.duration_ms >= TRACE_SLOW_MS:
+        metrics.increment("rag_slow_requests_total", (("pipeline", name),))
+        logger.warning("slow %s %.1f ms: %s", name, root.duration_ms, json.dumps(root.to_dict(), default=str))
+
+
+def _labels(pairs):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}" if pairs else ""
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render_prometheus():
+    """
+    Prometheus text exposition of stage durations, counters and the gauges of `metrics.gauge_source`,
+    which maps a metric name to (help, value) or (help, {label tuple: value}). With METRICS_DIR set,
+    durations and counters are summed over all processes and each live worker's gauges carry a
+    `worker` label.
+    """
+    states = metrics.collect()
+    cutoff = time.time() - TRACE_WINDOW_SECONDS
+    durations, counters, gauges = {}, {}, {}
+    for state in states:
+        for stage, histogram in state["durations"].items():
+            merged = durations.setdefault(stage, {"counts": [0] * (len(DURATION_BUCKETS) + 1), "total": 0.0,
+                                                  "observations": 0, "recent": []})
+            merged["counts"] = [a + b for a, b in zip(merged["counts"], histogram["counts"])]
+            merged["total"] += histogram["total"]
+            merged["observations"] += histogram["observations"]
+            merged["recent"].extend(value for at, value in histogram["recent"] if at >= cutoff)
+        for name, labels, value in state["counters"]:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        if metrics.shared_dir and not _process_alive(state["pid"]):
+            continue
+        worker = (("worker", state["pid"]),) if metrics.shared_dir else ()
+        for name, (help_text, samples) in state["gauges"].items():
+            values = gauges.setdefault(name, (help_text, {}))[1]
+            for labels, sample in samples:
+                values[tuple(tuple(pair) for pair in labels) + worker] = sample
+
+    lines = [
+        "# HELP rag_stage_duration_seconds Duration of RAG pipeline stages.",
+        "# TYPE rag_stage_duration_seconds histogram",
+    ]
+    recent_lines = [
+        f"# HELP rag_stage_recent_duration_seconds Stage duration quantiles over the last {TRACE_WINDOW_SECONDS}s.",
+        "# TYPE rag_stage_recent_duration_seconds summary",
+    ]
+    for stage, histogram in sorted(durations.items()):
+        counts, total, observations = histogram["counts"], histogram["total"], histogram["observations"]
+        recent = sorted(histogram["recent"])
+        cumulative = 0
+        for bound, bucket_count in zip(DURATION_BUCKETS, counts):
+            cumulative += bucket_count
+            lines.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {observations}')
+        lines.append(f'rag_stage_duration_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        lines.append(f'rag_stage_duration_seconds_count{{stage="{stage}"}} {observations}')
+        for quantile in QUANTILES:
+            value = recent[min(len(recent) - 1, int(quantile * len(recent)))] if recent else float("nan")
+            recent_lines.append(f'rag_stage_recent_duration_seconds{{stage="{stage}",quantile="{quantile}"}} {value:.6f}')
+        recent_lines.append(f'rag_stage_recent_duration_seconds_sum{{stage="{stage}"}} {sum(recent):.6f}')
+        recent_lines.append(f'rag_stage_recent_duration_seconds_count{{stage="{stage}"}} {len(recent)}')
+    lines.extend(recent_lines)
+
+    counters = sorted(counters.items())
+    for name in sorted({name for (name, _), _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        lines.extend(f"{name}{_labels(labels)} {value}" for (counter, labels), value in counters if counter == name)
+
+    for name, (help_text, values) in sorted(gauges.items()):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{_labels(labels)} {sample}" for labels, sample in sorted(values.items()))
+    return "\n".join(lines) + "\n"
+
+
+def submit_traced(executor, fn, *args):
+    """executor.submit that keeps the caller's current span, so worker stages nest under it."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
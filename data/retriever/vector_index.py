@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import argparse
+import threading
+import numpy as np
+
+from data.graph_version import read_graph_version
+from data.embedding_profile import LEGACY_PROFILE, profile_name, vector_property
+
+SNAPSHOT_DTYPES = ("float32", "float16", "int8")
+SCORE_BLOCK_ROWS = 16384
+ROUTER_CENTROIDS_PER_LABEL = int(os.getenv("ROUTER_CENTROIDS_PER_LABEL", "4"))
+
+
+def normalise_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    # Embeddings usually arrive unit length; skip the full-size copy for them
+    if np.allclose(norms, 1.0, atol=1e-5):
+        return matrix
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+# -------------------------
+# Snapshot building
+# -------------------------
+def train_partitions(vectors, nlist, iterations=10, sample_size=None, seed=0):
+    """Spherical k-means: returns unit-length centroids for an IVF partitioning of `vectors`."""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), sample_size or nlist * 64)
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for list_id in range(nlist):
+            members = sample[assignment == list_id]
+            if len(members):
+                centroids[list_id] = members.mean(axis=0)
+        centroids = normalise_rows(centroids)
+    return centroids.astype(np.float32)
+
+
+def assign_partitions(vectors, centroids, batch_size=16384):
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        assignment[start:start + batch_size] = np.argmax(vectors[start:start + batch_size] @ centroids.T, axis=1)
+    return assignment
+
+
+def quantise(vectors, dtype):
+    """
+    Storage form of unit-length float32 rows: (matrix, per-row scales). int8 rows are scaled so their
+    largest component maps to 127 and carry that scale; float16 and float32 need none.
+    """
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0 if len(vectors) else np.ones(0)
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return vectors.astype(dtype), None
+
+
+def routing_centroids(vectors, count, sample_size=20000):
+    """Up to `count` unit-length k-means centroids summarising a label's vectors, for query routing."""
+    if len(vectors) > sample_size:
+        vectors = vectors[np.sort(np.random.default_rng(0).choice(len(vectors), sample_size, replace=False))]
+    if len(vectors) <= count:
+        return normalise_rows(np.array(vectors, dtype=np.float32))
+    return train_partitions(vectors, count, sample_size=len(vectors))
+
+
+def write_snapshot(snapshot_dir, label, names, vectors, ivf_min_size, dtype="float32", graph_version=None,
+                   profile=None, router_centroids=ROUTER_CENTROIDS_PER_LABEL):
+    """
+    Write one label's vectors as a contiguous .npy file (float32, or float16/int8 to shrink the
+    page-cache footprint at some recall cost) plus a JSON manifest.
+
+    Above `ivf_min_size` rows, vectors are partitioned with k-means and stored grouped by
+    partition so each list is a contiguous slice. Data files carry the build timestamp in
+    their name and the manifest is replaced last, so readers never see a half-written snapshot.
+    The manifest records the graph version the vectors were read at (default: the current one) and
+    the embedding profile they belong to. The label router's centroids are trained here too, so no
+    worker trains them on a request.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    built_at = time.time()
+    stamp = f"{built_at:.6f}".replace(".", "")
+    vectors = normalise_rows(np.asarray(vectors, dtype=np.float32))
+    meta = {"label": label, "built_at": built_at, "count": len(names),
+            "graph_version": read_graph_version() if graph_version is None else graph_version, "profile": profile,
+            "dimensions": int(vectors.shape[1]) if len(vectors) else 0, "ivf": None, "dtype": dtype, "scales": None}
+
+    if len(vectors) >= ivf_min_size:
+        nlist = max(1, int(np.sqrt(len(vectors))))
+        centroids = train_partitions(vectors, nlist)
+        assignment = assign_partitions(vectors, centroids)
+        order = np.argsort(assignment, kind="stable")
+        vectors = vectors[order]
+        names = [names[i] for i in order]
+        offsets = np.searchsorted(assignment[order], np.arange(nlist + 1)).tolist()
+        centroid_file = f"{label}.{stamp}.centroids.npy"
+        np.save(os.path.join(snapshot_dir, centroid_file), centroids)
+        meta["ivf"] = {"centroids": centroid_file, "offsets": offsets}
+
+    meta["router_centroids"] = f"{label}.{stamp}.router.npy"
+    np.save(os.path.join(snapshot_dir, meta["router_centroids"]), routing_centroids(vectors, router_centroids))
+
+    # Partitions are trained on the exact vectors; only the stored copy is quantised
+    vectors, scales = quantise(vectors, dtype)
+    if scales is not None:
+        meta["scales"] = f"{label}.{stamp}.scales.npy"
+        np.save(os.path.join(snapshot_dir, meta["scales"]), scales)
+    meta["vectors"] = f"{label}.{stamp}.vectors.npy"
+    meta["names"] = names
+    np.save(os.path.join(snapshot_dir, meta["vectors"]), vectors)
+
+    meta_path = os.path.join(snapshot_dir, f"{label}.meta.json")
+    previous = _read_meta(meta_path)
+    with open(f"{meta_path}.tmp", "w", encoding="utf-8") as file:
+        json.dump(meta, file)
+    os.replace(f"{meta_path}.tmp", meta_path)
+
+    # Processes that already mapped the old files keep their mapping after the unlink
+    if previous:
+        for old_file in (previous.get("vectors"), previous.get("scales"), (previous.get("ivf") or {}).get("centroids"),
+                         previous.get("router_centroids")):
+            if old_file and os.path.exists(os.path.join(snapshot_dir, old_file)):
+                os.remove(os.path.join(snapshot_dir, old_file))
+    return meta
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def read_label_vectors(tx, label, property="vector"):
+    """
+    Stream a label's vectors into one preallocated float32 matrix, normalised row by row, so only
+    the driver's current fetch batch exists as Python floats. Returns (names, matrix).
+    """
+    total = tx.run(f"MATCH (n:{label}) WHERE n.{property} IS NOT NULL RETURN count(n) AS total").single()["total"]
+    names, vectors = [], None
+    for record in tx.run(f"""
+        MATCH (n:{label}) WHERE n.{property} IS NOT NULL
+        RETURN n.name AS name, n.{property} AS vector
+    """):
+        if vectors is None:
+            vectors = np.empty((total, len(record["vector"])), dtype=np.float32)
+        # Nodes embedded after the count are left for the next build
+        if len(names) == total:
+            break
+        row = vectors[len(names)]
+        row[:] = record["vector"]
+        norm = np.linalg.norm(row)
+        if norm:
+            row /= norm
+        names.append(record["name"])
+    return names, (vectors[:len(names)] if vectors is not None else None)
+
+
+def build_snapshots(driver, labels, snapshot_dir, ivf_min_size, dtype="float32", profile=None,
+                    router_centroids=ROUTER_CENTROIDS_PER_LABEL):
+    """Export the vectors of an embedding profile (default: the configured one) into label snapshots."""
+    profile = profile or profile_name()
+    for label in labels:
+        # Read before the vectors: a change during the export leaves the snapshot stale, never wrongly fresh
+        graph_version = read_graph_version()
+        with driver.session() as session:
+            names, vectors = session.execute_read(read_label_vectors, label, vector_property(profile))
+        if not names:
+            print(f"Skipping {label}: no vectors")
+            continue
+        meta = write_snapshot(snapshot_dir, label, names, vectors, ivf_min_size, dtype, graph_version, profile,
+                              router_centroids)
+        print(f"Snapshot for {label}: {meta['count']} {dtype} vectors{' (IVF)' if meta['ivf'] else ''}")
+
+
+# -------------------------
+# Query side
+# -------------------------
+class LocalVectorIndex:
+    """
+    Top-k cosine search over memory-mapped label snapshots.
+
+    The .npy files are opened with mmap_mode="r", so every worker process on the host shares
+    the same page-cache copy instead of holding its own. `search` returns None when a label
+    has no snapshot, the snapshot is older than `max_age_seconds`, or it was built at another
+    graph version than `version_source()` reports (ingestion and the embedding backfill bump
+    it), or from another embedding profile than `profile`, so callers can fall back to the Neo4j
+    vector index.
+    """
+
+    def __init__(self, snapshot_dir, max_age_seconds, nprobe=8, version_source=None, profile=None):
+        self.snapshot_dir = snapshot_dir
+        self.max_age_seconds = max_age_seconds
+        self.nprobe = nprobe
+        self.version_source = version_source
+        self.profile = profile
+        self._labels = {}
+        self._lock = threading.Lock()
+
+    def _load(self, label):
+        meta_path = os.path.join(self.snapshot_dir, f"{label}.meta.json")
+        try:
+            mtime = os.stat(meta_path).st_mtime
+        except FileNotFoundError:
+            return None
+
+        loaded = self._labels.get(label)
+        if loaded and loaded["mtime"] == mtime:
+            return loaded
+
+        with self._lock:
+            meta = _read_meta(meta_path)
+            if not meta:
+                return None
+            loaded = {
+                "mtime": mtime,
+                "meta": meta,
+                "names": meta["names"],
+                "vectors": np.load(os.path.join(self.snapshot_dir, meta["vectors"]), mmap_mode="r"),
+                "scales": None,
+                "centroids": None,
+                "router_centroids": None,
+            }
+            if meta.get("scales"):
+                loaded["scales"] = np.load(os.path.join(self.snapshot_dir, meta["scales"]))
+            if meta["ivf"]:
+                loaded["centroids"] = np.load(os.path.join(self.snapshot_dir, meta["ivf"]["centroids"]))
+                loaded["offsets"] = meta["ivf"]["offsets"]
+            if meta.get("router_centroids"):
+                loaded["router_centroids"] = np.load(os.path.join(self.snapshot_dir, meta["router_centroids"]))
+            self._labels[label] = loaded
+            return loaded
+
+    def _matches_profile(self, loaded):
+        # Snapshots built before profiles were recorded hold the legacy `vector` property
+        return self.profile is None or (loaded["meta"].get("profile") or LEGACY_PROFILE) == self.profile
+
+    def is_fresh(self, label):
+        loaded = self._load(label)
+        if not loaded or time.time() - loaded["meta"]["built_at"] > self.max_age_seconds:
+            return False
+        if not self._matches_profile(loaded):
+            return False
+        return self.version_source is None or loaded["meta"].get("graph_version") == self.version_source()
+
+    def search(self, label, query_vector, top_k, threshold=0.0):
+        results = self.search_many(label, [query_vector], top_k, threshold)
+        return None if results is None else results[0]
+
+    def search_many(self, label, query_vectors, top_k, threshold=0.0):
+        """Answer a batch of queries for one label with matrix products; None if no fresh snapshot."""
+        if not self.is_fresh(label):
+            return None
+        loaded = self._labels[label]
+        queries = normalise_rows(np.asarray(query_vectors, dtype=np.float32))
+        if queries.shape[1] != loaded["meta"]["dimensions"]:
+            return None
+
+        if loaded["centroids"] is None:
+            return [self._top_k(loaded, self._scores(loaded, query), np.arange(len(loaded["names"])), top_k, threshold)
+                    for query in queries]
+
+        results = []
+        offsets = loaded["offsets"]
+        probes = np.argsort(-(queries @ loaded["centroids"].T), axis=1)[:, :self.nprobe]
+        for query, lists in zip(queries, probes):
+            rows = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in lists])
+            results.append(self._top_k(loaded, self._scores(loaded, query, rows), rows, top_k, threshold))
+        return results
+
+    @staticmethod
+    def _scores(loaded, query, rows=None):
+        """Cosine scores of `rows` (all rows by default); float16/int8 rows are widened block by block."""
+        vectors = loaded["vectors"] if rows is None else loaded["vectors"][rows]
+        if vectors.dtype == np.float32:
+            scores = vectors @ query
+        else:
+            scores = np.empty(len(vectors), dtype=np.float32)
+            for start in range(0, len(vectors), SCORE_BLOCK_ROWS):
+                scores[start:start + SCORE_BLOCK_ROWS] = vectors[start:start + SCORE_BLOCK_ROWS].astype(np.float32) @ query
+        if loaded["scales"] is not None:
+            scores *= loaded["scales"] if rows is None else loaded["scales"][rows]
+        return scores
+
+    def label_centroids(self, label):
+        """
+        The routing centroids stored with a label's snapshot, or None for snapshots built before they
+        were (rebuild them to route to that label). Stale snapshots still qualify, label topics drift
+        slowly, but snapshots of another embedding profile do not.
+        """
+        loaded = self._load(label)
+        if not loaded or not loaded["names"] or not self._matches_profile(loaded):
+            return None
+        return loaded["router_centroids"]
+
+    @staticmethod
+    def _top_k(loaded, scores, rows, top_k, threshold):
+        if len(scores) > top_k:
+            candidates = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            candidates = np.arange(len(scores))
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(loaded["names"][rows[i]], float(scores[i])) for i in candidates if scores[i] >= threshold]
+
+
+# -------------------------
+# Build snapshots from Neo4j
+# -------------------------
+if __name__ == "__main__":
+    from data.clients import get_driver, close_clients
+    from data.constants import schema_description
+    from data.embedding_profile import VECTOR_SNAPSHOT_DTYPE
+
+    parser = argparse.ArgumentParser(description="Export Neo4j vectors into memory-mapped label snapshots.")
+    parser.add_argument("--labels", nargs="*", default=list(schema_description))
+    parser.add_argument("--snapshot-dir", default=os.getenv("VECTOR_SNAPSHOT_DIR", ".cache/vector_snapshots"))
+    parser.add_argument("--ivf-min-size", type=int, default=int(os.getenv("VECTOR_IVF_MIN_SIZE", "50000")))
+    parser.add_argument("--dtype", default=VECTOR_SNAPSHOT_DTYPE, choices=SNAPSHOT_DTYPES)
+    parser.add_argument("--router-centroids", type=int, default=ROUTER_CENTROIDS_PER_LABEL,
+                        help="k-means centroids stored per label for query routing (default: ROUTER_CENTROIDS_PER_LABEL)")
+    args = parser.parse_args()
+
+    build_snapshots(get_driver(), args.labels, args.snapshot_dir, args.ivf_min_size, args.dtype,
+                    router_centroids=args.router_centroids)
+    close_clients()
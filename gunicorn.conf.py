@@ -0,0 +1,37 @@
+import os
+import shutil
+import subprocess
+import sys
+from data.clients import warm_pool, close_clients
+
+# Workers sum their /metrics through this directory; set before they fork and import tracing
+os.environ.setdefault("METRICS_DIR", os.path.join(".cache", "metrics"))
+from data.retriever.tracing import metrics  # noqa: E402
+
+# gunicorn -c gunicorn.conf.py app:app
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+
+def on_starting(server):
+    # Schema upgrades run once, before any worker forks, in a separate interpreter so the
+    # master never holds database connections that workers would inherit
+    subprocess.run([sys.executable, "-m", "flask", "--app", "app", "init-db"], check=True)
+    # Metric files of a previous server run would otherwise be added to this run's totals
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+
+
+def post_worker_init(worker):
+    # Clients are created after the fork, so each worker warms its own Neo4j pool
+    warm_pool()
+    # Load the tokenizer before the first request rather than on it
+    from data.retriever.context_packer import load_token_counter
+    from data.retriever.hybrid_retriever import model
+    load_token_counter(model)
+
+
+def worker_exit(server, worker):
+    # Keep the exited worker's counters in the shared totals, without its gauges
+    metrics.flush(final=True)
+    close_clients()
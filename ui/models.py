@@ -1,9 +1,19 @@
+import re
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
 from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
 
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces ON DELETE CASCADE with foreign keys switched on per connection
+    if type(dbapi_connection).__module__.startswith("sqlite3"):
+        dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(150), unique=True, nullable=False)
@@ -12,16 +22,130 @@ class User(UserMixin, db.Model):
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
+    sessions = db.relationship('ChatSession', backref='user', lazy='dynamic',
+                               cascade='all, delete-orphan', passive_deletes=True)
+
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
 class ChatSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    # First user message, denormalised so the sidebar and search never query Chat per session
+    title = db.Column(db.String(200))
+    messages = db.relationship('Chat', backref='chat_session', lazy='dynamic',
+                               cascade='all, delete-orphan', passive_deletes=True)
 
 class Chat(db.Model):
+    __table_args__ = (db.Index('ix_chat_session_timestamp', 'session_id', 'timestamp', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
-    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id', ondelete='CASCADE'), nullable=False)
     message = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
     sender = db.Column(db.String(10), nullable=False)
+
+
+def delete_sessions(user_id, session_id=None):
+    """
+    Delete a user's chat sessions (or just `session_id`) with one set-based statement, independent
+    of how many sessions there are; ON DELETE CASCADE removes their messages. Returns the deleted
+    session ids.
+    """
+    sessions = db.session.query(ChatSession.id).filter(ChatSession.user_id == user_id)
+    if session_id is not None:
+        sessions = sessions.filter(ChatSession.id == session_id)
+    session_ids = [row.id for row in sessions]
+    if session_ids:
+        (ChatSession.query.filter(ChatSession.user_id == user_id, ChatSession.id.in_(session_ids))
+         .delete(synchronize_session=False))
+    db.session.commit()
+    return session_ids
+
+
+def init_search_schema():
+    """
+    Bring an existing database up to the current schema and set up chat search.
+
+    Adds ChatSession.title when missing and backfills it from each session's first user
+    message, and adds the Chat (session_id, timestamp, id) index that create_all() skips on
+    existing tables. On SQLite, also creates an FTS5 index over Chat.message kept in sync by triggers.
+    """
+    columns = {column['name'] for column in inspect(db.engine).get_columns('chat_session')}
+    if 'title' not in columns:
+        db.session.execute(text("ALTER TABLE chat_session ADD COLUMN title VARCHAR(200)"))
+    db.session.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_chat_session_timestamp ON chat (session_id, timestamp, id)"
+    ))
+    db.session.execute(text("""
+        UPDATE chat_session SET title = (
+            SELECT substr(chat.message, 1, 200) FROM chat
+            WHERE chat.session_id = chat_session.id AND chat.sender = 'user'
+            ORDER BY chat.timestamp LIMIT 1
+        )
+        WHERE title IS NULL
+    """))
+
+    if db.engine.dialect.name == 'sqlite':
+        exists = db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_fts'"
+        )).first()
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5(message, content='chat', content_rowid='id')"
+        ))
+        db.session.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS chat_fts_insert AFTER INSERT ON chat BEGIN
+                INSERT INTO chat_fts(rowid, message) VALUES (new.id, new.message);
+            END
+        """))
+        db.session.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS chat_fts_delete AFTER DELETE ON chat BEGIN
+                INSERT INTO chat_fts(chat_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            END
+        """))
+        db.session.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS chat_fts_update AFTER UPDATE ON chat BEGIN
+                INSERT INTO chat_fts(chat_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                INSERT INTO chat_fts(rowid, message) VALUES (new.id, new.message);
+            END
+        """))
+        if not exists:
+            db.session.execute(text("INSERT INTO chat_fts(chat_fts) VALUES ('rebuild')"))
+    db.session.commit()
+
+
+def search_sessions(user_id, query, limit=5):
+    """
+    Return (session id, title) pairs whose messages match `query`, in a single query. An empty
+    query matches every session with a message, as the search did before it was indexed.
+    """
+    if not query.strip():
+        rows = (db.session.query(ChatSession.id, ChatSession.title)
+                .filter(ChatSession.user_id == user_id,
+                        db.session.query(Chat.id).filter(Chat.session_id == ChatSession.id).exists())
+                .order_by(ChatSession.id)
+                .limit(limit))
+    elif db.engine.dialect.name == 'sqlite':
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return []
+        match = " ".join(f'"{term}"*' for term in terms)
+        rows = db.session.execute(text("""
+            SELECT chat_session.id, chat_session.title
+            FROM chat_fts
+            JOIN chat ON chat.id = chat_fts.rowid
+            JOIN chat_session ON chat_session.id = chat.session_id
+            WHERE chat_fts MATCH :match AND chat_session.user_id = :user_id
+            GROUP BY chat_session.id
+            ORDER BY min(chat_fts.rank)
+            LIMIT :limit
+        """), {"match": match, "user_id": user_id, "limit": limit})
+    else:
+        pattern = re.sub(r'([\\%_])', r'\\\1', query)
+        rows = (db.session.query(ChatSession.id, ChatSession.title)
+                .join(Chat, Chat.session_id == ChatSession.id)
+                .filter(ChatSession.user_id == user_id, Chat.message.ilike(f"%{pattern}%", escape='\\'))
+                .group_by(ChatSession.id, ChatSession.title)
+                .order_by(ChatSession.id.desc())
+                .limit(limit))
+    return [(session_id, title or f"Chat {session_id}") for session_id, title in rows]